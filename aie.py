@@ -0,0 +1,146 @@
+'''
+Command line front end for the editing engine.
+
+    python aie.py resize --height 480 --pendulum in/*.gif -o out/
+    python aie.py reverse --format webp in/*.gif -o out/
+    python aie.py merge left.gif right.webp -o merged.gif
+'''
+
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import engine
+
+FILE_COMMANDS = ["resize", "crop", "reverse", "pendulum", "convert"]
+PAIR_COMMANDS = ["merge", "concat"]
+
+def parse_box(text):
+    box = tuple(int(v) for v in text.split(","))
+    if len(box) != 4:
+        raise argparse.ArgumentTypeError("expected LEFT,TOP,RIGHT,BOTTOM")
+    return box
+
+def expand_inputs(patterns):
+    # the Windows shell does not expand wildcards for us
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if matches else [pattern])
+    return paths
+
+def apply_edits(frames, durations, args):
+    # same order a user would typically apply them in the editor
+    if args.crop:
+        frames = engine.crop_frames(frames, args.crop)
+    if args.height:
+        frames = engine.resize_frames(frames, args.height, engine.RESAMPLE_FILTERS[args.filter])
+    if args.reverse:
+        frames, durations = engine.reverse_frames(frames, durations)
+    if args.pendulum:
+        frames, durations = engine.pendulum_frames(frames, durations)
+    return frames, durations
+
+def output_path(in_path, out_dir, fmt):
+    stem, ext = os.path.splitext(os.path.basename(in_path))
+    ext = "." + fmt if fmt else ext.lower()
+    if ext not in engine.EXPORT_EXTENSIONS:
+        ext = ".gif"
+    return os.path.join(out_dir, stem + ext)
+
+def load(path):
+    frames, durations = engine.load_animation(path, engine.COALESCE_ON_LOAD)
+    if engine.COALESCE_ON_LOAD:
+        frames, durations, _ = engine.coalesce_frames(frames, durations)
+    return frames, durations
+
+def process_file(in_path, out_path, args):
+    # files already run one per process, more threads would only oversubscribe
+    engine.WORKERS = args.threads or 1
+    frames, durations = load(in_path)
+    frames, durations = apply_edits(frames, durations, args)
+    result = engine.export_animation(out_path, frames, durations, not args.keep_duplicates, args.profile,
+                                     dither=engine.GIF_DITHERS.get(args.dither))
+    return f"{out_path} ({result.summary()})"
+
+def process_pair(args):
+    if args.threads:
+        engine.WORKERS = args.threads
+    frames1, durations1 = load(args.inputs[0])
+    frames2, durations2 = load(args.inputs[1])
+    if args.command == "merge":
+        frames, durations = engine.merge_animations(frames1, durations1, frames2, durations2,
+                                                    args.tick, args.max_frames)
+    else:
+        frames, durations = engine.concat_animations(frames1, durations1, frames2, durations2)
+    frames, durations = apply_edits(frames, durations, args)
+    result = engine.export_animation(args.output, frames, durations, not args.keep_duplicates, args.profile,
+                                     dither=engine.GIF_DITHERS.get(args.dither))
+    return f"{args.output} ({result.summary()})"
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("inputs", nargs="+", help="input animations (wildcards allowed)")
+    common.add_argument("-o", "--output", required=True,
+                        help="output directory, or output file for merge/concat")
+    common.add_argument("--height", type=int, help="resize to this height, keeping the aspect ratio")
+    common.add_argument("--filter", choices=list(engine.RESAMPLE_FILTERS), default="lanczos",
+                        help="resampling filter for --height, best quality first")
+    common.add_argument("--crop", type=parse_box, metavar="L,T,R,B", help="crop box in source pixels")
+    common.add_argument("--reverse", action="store_true", help="play backward")
+    common.add_argument("--pendulum", action="store_true", help="play back and forth")
+    common.add_argument("--format", choices=["gif", "webp"], help="output format (default: same as input)")
+    common.add_argument("--profile", choices=list(engine.EXPORT_PROFILES), default=engine.DEFAULT_EXPORT_PROFILE,
+                        help="export speed/size trade-off, fastest first (default: %(default)s)")
+    common.add_argument("--dither", choices=list(engine.GIF_DITHERS),
+                        help="GIF dithering (default: the profile's); ordered is faster than floyd-steinberg")
+    common.add_argument("--keep-duplicates", action="store_true",
+                        help="don't merge identical consecutive frames on export")
+    common.add_argument("--tick", type=int, default=engine.MERGE_TICK,
+                        help="merge: snap frame changes to this many ms (default: %(default)s, the GIF delay unit)")
+    common.add_argument("--max-frames", type=int, help="merge: cap the number of output frames")
+    common.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    common.add_argument("--threads", type=int,
+                        help="threads for per-frame work (default: 1 per file, all cores for merge/concat)")
+
+    parser = argparse.ArgumentParser(prog="aie", description="Batch edit animated GIF/WEBP files.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for command in FILE_COMMANDS + PAIR_COMMANDS:
+        sub.add_parser(command, parents=[common])
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "resize" and not args.height:
+        parser.error("resize needs --height")
+    if args.command == "crop" and not args.crop:
+        parser.error("crop needs --crop")
+    args.reverse = args.reverse or args.command == "reverse"
+    args.pendulum = args.pendulum or args.command == "pendulum"
+
+    if args.command in PAIR_COMMANDS:
+        if len(args.inputs) != 2:
+            parser.error(f"{args.command} needs exactly two inputs")
+        print(process_pair(args))
+        return 0
+
+    inputs = expand_inputs(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = {
+            pool.submit(process_file, path, output_path(path, args.output, args.format), args): path
+            for path in inputs
+        }
+        for future in as_completed(futures):
+            try:
+                print(future.result())
+            except Exception as e:
+                failed += 1
+                print(f"failed: {futures[future]}: {e}", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
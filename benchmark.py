@@ -0,0 +1,364 @@
+'''
+Benchmarks for the editing hot paths, run headless on synthetic animations.
+
+    python benchmark.py -o results.json
+    python benchmark.py --suite full -o results.json
+    python benchmark.py --compare before.json after.json
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+import PIL
+from PIL import Image, ImageDraw
+import engine
+import frame_store
+
+# (width, height, frame count) of the generated fixtures
+SUITES = {
+    "quick": [(160, 120, 24), (480, 360, 60)],
+    "full": [(160, 120, 24), (480, 360, 60), (1280, 720, 150), (320, 240, 1000)],
+}
+FIXTURE_DIR = os.path.join(tempfile.gettempdir(), "aie-bench-fixtures")
+# every case runs in a process of its own, so caches, the allocator and the
+# peak memory of one case never carry over into the next
+ENGINE_CASES = [
+    "load_animation[gif]", "load_animation[webp]", "resize_frames", "crop_frames", "reverse_frames",
+    "pendulum_frames", "merge_images", "export_animation[gif]", "export_animation[webp]",
+]
+GUI_CASES = ["populate_frame_area", "display_frame", "display_frame[rescaled]", "handle_concat"]
+
+# FIXTURES
+def synthetic_frames(width, height, count, seed=0):
+    # A gradient background with a moving box and a patch of noise, enough
+    # change between frames to keep palettes and encoders honest
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frames = []
+    for i in range(count):
+        phase = 255 * i / count
+        pixels = np.empty((height, width, 3), np.uint8)
+        pixels[..., 0] = (x + phase) % 256
+        pixels[..., 1] = (y + phase / 2) % 256
+        pixels[..., 2] = (x + y) / 2
+        h, w = height // 4, width // 4
+        pixels[:h, :w] = rng.integers(0, 256, (h, w, 3), np.uint8)
+        frame = Image.fromarray(pixels)
+        left = (width - w) * i // max(1, count - 1)
+        ImageDraw.Draw(frame).rectangle((left, height // 2, left + w, height // 2 + h), fill=(255, 255, 255))
+        frames.append(frame)
+    return frames
+
+def fixture(width, height, count, ext):
+    # generated once and kept, so runs on different commits read the same files
+    path = os.path.join(FIXTURE_DIR, f"{width}x{height}x{count}{ext}")
+    if not os.path.exists(path):
+        os.makedirs(FIXTURE_DIR, exist_ok=True)
+        frames = synthetic_frames(width, height, count)
+        partial = path + ".partial"
+        frames[0].save(partial, format=ext[1:].upper(), save_all=True, append_images=frames[1:],
+                       duration=40, loop=0)
+        os.replace(partial, path)
+    return path
+
+# MEASURING
+def read_status(field):
+    # a /proc/self/status value in bytes, or None where there is none
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak():
+    # Resets the process' peak RSS (Linux). Elsewhere memory is measured with
+    # tracemalloc, which only sees Python and NumPy allocations.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return read_status("VmHWM") is not None
+    except OSError:
+        return False
+
+def measure(fn):
+    # (seconds, peak memory above the start in bytes, how memory was measured).
+    # Runs are cold: the decoded frame and export caches are emptied first.
+    frame_store.frame_cache.clear()
+    engine.export_cache.clear()
+    gc.collect()
+    if reset_peak():
+        method, before = "rss", read_status("VmRSS")
+    else:
+        method = "tracemalloc"
+        tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    if method == "rss":
+        peak = max(0, read_status("VmHWM") - before)
+    else:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak, method
+
+def consume(frames):
+    # decodes every frame of a (possibly lazy) result
+    for frame in frames:
+        frame.getbbox()
+
+# CASES
+def engine_cases(gif, webp, tmp_dir):
+    # name: (fixture, operation(data), setup() returning data or None)
+    def loaded(path):
+        return lambda: engine.load_animation(path)
+
+    def loaded_pair():
+        return (*engine.load_animation(gif), *engine.load_animation(webp))
+
+    def load(path):
+        return lambda data: consume(engine.load_animation(path)[0])
+
+    def resize(data):
+        frames, _ = data
+        consume(engine.resize_frames(frames, frames[0].size[1] // 2))
+
+    def crop(data):
+        frames, _ = data
+        w, h = frames[0].size
+        consume(engine.crop_frames(frames, (w // 4, h // 4, w * 3 // 4, h * 3 // 4)))
+
+    def reverse(data):
+        engine.reverse_frames(*data)
+
+    def pendulum(data):
+        engine.pendulum_frames(*data)
+
+    def merge(data):
+        consume(engine.merge_animations(*data)[0])
+
+    def export(ext):
+        return lambda data: engine.export_animation(os.path.join(tmp_dir, "export" + ext), *data)
+
+    return {
+        "load_animation[gif]": (gif, load(gif), None),
+        "load_animation[webp]": (webp, load(webp), None),
+        "resize_frames": (gif, resize, loaded(gif)),
+        "crop_frames": (gif, crop, loaded(gif)),
+        "reverse_frames": (gif, reverse, loaded(gif)),
+        "pendulum_frames": (gif, pendulum, loaded(gif)),
+        "merge_images": (gif, merge, loaded_pair),
+        "export_animation[gif]": (gif, export(".gif"), loaded(gif)),
+        "export_animation[webp]": (gif, export(".webp"), loaded(gif)),
+    }
+
+class Editor:
+    # Drives main.AnimatedImageEditor without a display
+    def __init__(self):
+        from PyQt6.QtWidgets import QApplication, QMessageBox
+        import main
+        self.main = main
+        self.app = QApplication.instance() or QApplication([])
+        # nothing may wait for a click
+        QMessageBox.information = staticmethod(lambda *args, **kwargs: None)
+        QMessageBox.critical = staticmethod(lambda *args, **kwargs: print("error:", args[2], file=sys.stderr))
+        self.window = main.AnimatedImageEditor()
+        self.window.show()
+        self.flush()
+
+    def flush(self):
+        from PyQt6.QtCore import QEvent
+        self.app.processEvents()
+        self.app.sendPostedEvents(None, QEvent.Type.DeferredDelete.value)
+        self.app.processEvents()
+
+    def wait(self):
+        while self.window.busy():
+            self.app.processEvents()
+        self.flush()
+
+    def show(self, path):
+        label = self.window.MDL(0)
+        label.show_animation(*engine.load_animation(path))
+        self.flush()
+        return label
+
+    def cases(self, gif, webp):
+        window = self.window
+
+        def populate(label):
+            label.populate_frame_area()
+            label.timeline().viewport().repaint()
+
+        def display(label):
+            # cold: every frame is decoded and scaled
+            label.scaled_pixmaps.clear()
+            label.preview_pyramid.clear()
+            for index in range(len(label.frames)):
+                label.display_frame(index)
+
+        def shown_all(label):
+            for index in range(len(label.frames)):
+                label.display_frame(index)
+            return label
+
+        def rescale(label):
+            # every frame again after a window resize
+            label.scaled_pixmaps.clear()
+            for index in range(len(label.frames)):
+                label.display_frame(index)
+
+        def concat(label):
+            window.enable_dual_mode(webp, self.main.MODE_CONCAT)
+            self.wait()
+            return label
+
+        def handle_concat(label):
+            window.handle_concat()
+            self.wait()
+
+        def shown(path, then=None):
+            def setup():
+                label = self.show(path)
+                return then(label) if then else label
+            return setup
+
+        return {
+            "populate_frame_area": (gif, populate, shown(gif)),
+            "display_frame": (gif, display, shown(gif)),
+            "display_frame[rescaled]": (gif, rescale, shown(gif, shown_all)),
+            "handle_concat": (gif, handle_concat, shown(gif, concat)),
+        }
+
+def run_case(name, path, count, op, setup, repeat):
+    # median time of repeat runs, memory of the first; setup is not measured
+    times = []
+    peak, method = None, None
+    for run in range(repeat):
+        data = setup() if setup else None
+        seconds, run_peak, run_method = measure(lambda: op(data))
+        times.append(seconds)
+        if run == 0:
+            peak, method = run_peak, run_method
+    seconds = statistics.median(times)
+    return {
+        "name": name,
+        "fixture": os.path.basename(path),
+        "frames": count,
+        "seconds": seconds,
+        "runs": times,
+        "per_frame_ms": 1000 * seconds / count,
+        "peak_mb": peak / 2 ** 20,
+        "memory": method,
+    }
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def run_one(name, size, repeat):
+    width, height, count = size
+    gif = fixture(width, height, count, ".gif")
+    webp = fixture(width, height, count, ".webp")
+    with tempfile.TemporaryDirectory(prefix="aie-bench-") as tmp_dir:
+        if name in GUI_CASES:
+            cases = Editor().cases(gif, webp)
+        else:
+            cases = engine_cases(gif, webp, tmp_dir)
+        path, op, setup = cases[name]
+        return run_case(name, path, count, op, setup, repeat)
+
+def run_suite(suite, repeat, gui, only):
+    names = ENGINE_CASES + (GUI_CASES if gui else [])
+    if only:
+        names = [name for name in names if any(word in name for word in only)]
+    results = []
+    for size in SUITES[suite]:
+        # made here, not by the cases running side by side
+        fixture(*size, ".gif")
+        fixture(*size, ".webp")
+        for name in names:
+            command = [sys.executable, os.path.abspath(__file__), "--case", name,
+                       "--size", *map(str, size), "--repeat", str(repeat)]
+            out = subprocess.run(command, capture_output=True, text=True)
+            if out.returncode != 0:
+                print(f"failed: {name} {size}: {out.stderr.strip()}", file=sys.stderr)
+                continue
+            result = json.loads(out.stdout.splitlines()[-1])
+            results.append(result)
+            print(f"{result['fixture']:>20} {name:<24} {result['seconds'] * 1000:9.1f} ms"
+                  f" {result['per_frame_ms']:8.2f} ms/frame {result['peak_mb']:8.1f} MB", flush=True)
+    return {
+        "commit": git_commit(),
+        "suite": suite,
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "workers": engine.WORKERS,
+        "results": results,
+    }
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    old = {(r["fixture"], r["name"]): r for r in before["results"]}
+    for r in after["results"]:
+        b = old.get((r["fixture"], r["name"]))
+        if b is None:
+            continue
+        ratio = r["seconds"] / b["seconds"] if b["seconds"] else float("inf")
+        print(f"{r['fixture']:>20} {r['name']:<24} {b['seconds'] * 1000:9.1f} -> {r['seconds'] * 1000:9.1f} ms"
+              f" (x{ratio:.2f})  {b['peak_mb']:7.1f} -> {r['peak_mb']:7.1f} MB")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark", description="Time the editor's hot paths on synthetic animations.")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--suite", choices=list(SUITES), default="quick", help="fixture sizes to run (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the median is reported")
+    parser.add_argument("--no-gui", action="store_true", help="skip the cases that need Qt")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="run only cases whose name contains one of these")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files and exit")
+    # one case in this process, used by the suite
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+    if args.case:
+        print(json.dumps(run_one(args.case, args.size, max(1, args.repeat))))
+        return 0
+    report = run_suite(args.suite, max(1, args.repeat), not args.no_gui, args.only)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,949 @@
+import hashlib
+import os
+import tempfile
+import time
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+from math import modf, isclose, ceil, floor, sqrt
+import numpy as np
+import PIL
+from PIL import Image, GifImagePlugin
+from frame_store import FrameSequence, FrameStack, TransformedFrame, frame_cache, stack_of, restacked, resample_frame, transformed
+from tracing import tracer, traced
+
+# Qt-free editing operations shared by the GUI (main.py) and the command line
+# tool (aie.py). Functions take frames as any sequence of PIL images (a list or
+# a FrameSequence) and return new lists; inputs are never modified. Frames that
+# all live in one FrameStack take vectorized paths and come back stacked. Crop,
+# resize and letterbox only record a transform of each frame, which is rendered
+# in one pass from the original frame when the frame is used.
+# Long operations take an optional progress(done, total) callback, which may
+# raise Cancelled to abandon the operation.
+
+SUPPORTED_EXTENSIONS = [".gif", ".webp", ".jpg", ".jpeg", ".png"]
+EXPORT_EXTENSIONS = [".gif", ".webp"]
+
+# resampling filters offered for resizing, best quality first
+RESAMPLE_FILTERS = {
+    "lanczos": Image.LANCZOS,
+    "bicubic": Image.BICUBIC,
+    "bilinear": Image.BILINEAR,
+    "nearest": Image.NEAREST,
+}
+# GIF dithering that can be picked instead of an export profile's
+GIF_DITHERS = {
+    "floyd-steinberg": Image.Dither.FLOYDSTEINBERG,
+    "ordered": Image.Dither.ORDERED,
+    "none": Image.Dither.NONE,
+}
+# Downscales by this factor or more first shrink with Image.reduce (a cheap box
+# filter) and only run the selected filter over the last step.
+REDUCING_GAP = 2.0
+WORKERS = os.cpu_count() or 1
+# merged frame boundaries snap to this many ms, the unit of GIF frame delays
+MERGE_TICK = 10
+# largest width or height of a merged animation
+MERGE_MAX_SIZE = 1920
+# Fold identical neighbouring frames when an animation is loaded (they are
+# always folded on export). Enable with AIE_COALESCE_ON_LOAD=1.
+COALESCE_ON_LOAD = os.environ.get("AIE_COALESCE_ON_LOAD", "0") == "1"
+# GIF palettes taken from frames themselves ("first" below) cover this many frames
+GIF_PALETTE_CHUNK = 64
+# GIF export quantizes at most this many frames at a time
+QUANTIZE_WINDOW = 32
+# Pillow versions (from, up to but not including) whose private WebP encoder
+# WEBP export was checked against and feeds frame by frame; it writes the
+# same bytes as save_all, which every other version uses.
+WEBP_STREAM_PILLOW = ((11, 2), (13, 0))
+# Sampled GIF palettes are built from at most this many pixels, taken evenly
+# from every frame (at least PALETTE_FRAME_SAMPLE from each); k-means refines
+# them on a subset of at most PALETTE_KMEANS_SAMPLE of those pixels.
+PALETTE_SAMPLE_PIXELS = 1 << 18
+PALETTE_FRAME_SAMPLE = 1024
+PALETTE_KMEANS_SAMPLE = 1 << 16
+# Per-scene palettes start a new scene where a frame's coarse color histogram
+# is this far (L1 distance, 0 to 2) from the first frame of the scene.
+PALETTE_SCENE_CUT = 0.5
+# Byte budget for what GIF export keeps for the next export of the same
+# frames (samples, palettes, encoded frame deltas).
+# Override with AIE_EXPORT_CACHE_MB=<megabytes>.
+EXPORT_CACHE_BYTES = int(os.environ.get("AIE_EXPORT_CACHE_MB", "256")) * 1024 * 1024
+# ordered dithering moves each channel by up to about half this much
+ORDERED_DITHER_STRENGTH = 24
+BAYER_4X4 = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]])
+# Export presets, fastest first.
+# webp_method runs from 0 (fast) to 6 (small), webp_still_method is the same
+# for single-frame files (Pillow's default differs for those) and
+# webp_quality is the effort for lossless output. gif_palette is where GIF
+# palettes come from: "first" takes one from the first of every
+# gif_palette_chunk frames (fewer means truer colors but more time), "global"
+# builds one from a sample of every frame and "scenes" one per scene;
+# gif_kmeans refines sampled palettes with that many k-means rounds.
+# gif_dither is one of GIF_DITHERS; Image.Dither.ORDERED quantizes faster
+# than Floyd-Steinberg and keeps frame deltas smaller on photographic content,
+# but adds a pattern to flat colors, so no profile uses it.
+# gif_optimize trims unused palette entries.
+EXPORT_PROFILES = {
+    "draft": {
+        "webp_method": 0, "webp_still_method": 0, "webp_quality": 60,
+        "webp_lossless": False, "webp_minimize_size": False,
+        "gif_dither": Image.Dither.NONE, "gif_palette": "global", "gif_kmeans": 0, "gif_palette_chunk": GIF_PALETTE_CHUNK,
+        "gif_optimize": False,
+    },
+    "balanced": {
+        "webp_method": 0, "webp_still_method": 4, "webp_quality": 80,
+        "webp_lossless": False, "webp_minimize_size": False,
+        "gif_dither": Image.Dither.FLOYDSTEINBERG, "gif_palette": "scenes", "gif_kmeans": 2, "gif_palette_chunk": GIF_PALETTE_CHUNK,
+        "gif_optimize": True,
+    },
+    "smallest": {
+        "webp_method": 6, "webp_still_method": 6, "webp_quality": 75,
+        "webp_lossless": False, "webp_minimize_size": True,
+        "gif_dither": Image.Dither.NONE, "gif_palette": "global", "gif_kmeans": 2, "gif_palette_chunk": GIF_PALETTE_CHUNK,
+        "gif_optimize": True,
+    },
+    "archival": {
+        "webp_method": 6, "webp_still_method": 6, "webp_quality": 100,
+        "webp_lossless": True, "webp_minimize_size": False,
+        "gif_dither": Image.Dither.FLOYDSTEINBERG, "gif_palette": "first", "gif_kmeans": 0, "gif_palette_chunk": 1,
+        "gif_optimize": True,
+    },
+}
+DEFAULT_EXPORT_PROFILE = "balanced"
+# a progressive load hands over what it decoded in this many seconds at a time
+LOAD_BATCH_SECONDS = 0.1
+
+def custom_round(op):
+    fractional_part, integer_part = modf(op)
+
+    if fractional_part > 0.5 or isclose(fractional_part, 0.5000, abs_tol=1e-4):
+        integer_part += 1
+        fractional_part = 0.0
+
+    return integer_part, fractional_part
+
+class Cancelled(Exception):
+    pass
+
+def reported(items, progress, total=None):
+    # items, calling progress(done, total) as each one has been used
+    if progress is None:
+        yield from items
+        return
+    total = len(items) if total is None else total
+    for done, item in enumerate(items, 1):
+        yield item
+        progress(done, total)
+
+def parallel_map(fn, items, workers=None):
+    # Ordered map over a thread pool (Pillow releases the GIL while it works).
+    # Items are pulled one at a time with a bounded number in flight, so lazy
+    # frames are decoded sequentially and only a window of them is alive.
+    workers = workers or WORKERS
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def load_animation(file_path, digests=False, progress=None):
+    # digests: hash frames during the load pass, for a coalesce_frames to follow
+    ext = os.path.splitext(file_path)[-1].lower()
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise ValueError(f"Unsupported file type: {ext}")
+    return FrameSequence.open(file_path, digests=digests, progress=progress)
+
+def load_batches(file_path, coalesce=False, progress=None, interval=LOAD_BATCH_SECONDS):
+    # load_animation for progressive display: yields (entries, durations,
+    # removed) batches, the first frame on its own and then whatever was
+    # decoded every interval seconds. With coalesce, runs of identical frames
+    # arrive folded into one frame (removed counts the folded frames), so a
+    # frame is held back until the next one shows whether its run goes on.
+    ext = os.path.splitext(file_path)[-1].lower()
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise ValueError(f"Unsupported file type: {ext}")
+    entries, durations, removed = [], [], 0
+    held = None
+    sent = False
+    last = time.perf_counter()
+    # identical frames share one entry when the load pass hashes them
+    for entry, duration in FrameSequence.read(file_path, digests=coalesce, progress=progress):
+        if coalesce:
+            if held is not None and held[0] is entry:
+                held[1] += duration
+                removed += 1
+                continue
+            if held is not None:
+                entries.append(held[0])
+                durations.append(held[1])
+            held = [entry, duration]
+        else:
+            entries.append(entry)
+            durations.append(duration)
+        if entries and (not sent or time.perf_counter() - last >= interval):
+            yield entries, durations, removed
+            entries, durations, removed = [], [], 0
+            sent = True
+            last = time.perf_counter()
+    if held is not None:
+        entries.append(held[0])
+        durations.append(held[1])
+    if entries or removed:
+        yield entries, durations, removed
+
+def coalesce_frames(frames, durations):
+    # Folds every run of pixel-identical consecutive frames into one frame
+    # shown for the run's total duration. Frames are compared by content hash,
+    # which each entry computes once. Returns the frames, the durations and
+    # the number of frames removed.
+    frames = frames if isinstance(frames, FrameSequence) else FrameSequence(frames)
+    digests = frame_digests(frames)
+    kept, kept_durations = [], []
+    last_digest = None
+    for i, duration in enumerate(durations):
+        entry = frames.entry(i)
+        if kept and entry is kept[-1]:
+            kept_durations[-1] += duration
+            continue
+        digest = digests[i]
+        if kept and digest == last_digest:
+            kept_durations[-1] += duration
+            continue
+        kept.append(entry)
+        kept_durations.append(duration)
+        last_digest = digest
+    return FrameSequence.from_entries(kept), kept_durations, len(frames) - len(kept)
+
+# SINGLE ANIMATION OPERATIONS
+def resize_frame(frame, size, resample=Image.LANCZOS):
+    return resample_frame(frame, size, resample, reducing_gap=REDUCING_GAP)
+
+def render_entry(entry):
+    # the pixels of entry, a transformed frame is rendered without caching it
+    return entry.render() if isinstance(entry, TransformedFrame) else entry.load()
+
+def prefetched(entries):
+    # (entry, pixels, rendered) for each entry, for finish_prefetched on the
+    # thread pool. Whatever has to be decoded, originals included, is loaded
+    # here in order, so lazy frames are decoded sequentially; a transformed
+    # frame that is not cached comes with its original's pixels instead.
+    for entry in entries:
+        frame = frame_cache.get(entry)
+        if frame is None and isinstance(entry, TransformedFrame):
+            yield entry, entry.base.load(), False
+        else:
+            yield entry, frame if frame is not None else entry.load(), True
+
+def finish_prefetched(item):
+    entry, frame, rendered = item
+    return frame if rendered else entry.load(frame)
+
+def rendered_frames(frames, workers=None):
+    # the frames of a sequence, with transformed ones rendered on the thread pool
+    frames = frames if isinstance(frames, FrameSequence) else FrameSequence(frames)
+    entries = (frames.entry(index) for index in range(len(frames)))
+    return parallel_map(finish_prefetched, prefetched(entries), workers)
+
+def frame_digests(frames, workers=None):
+    # Every frame's content hash. Entries compute theirs once; the missing
+    # ones are rendered and hashed on the thread pool.
+    frames = frames if isinstance(frames, FrameSequence) else FrameSequence(frames)
+    entries = frames.entries()
+    missing = [entry for entry in dict.fromkeys(entries) if entry._digest is None]
+    for _ in parallel_map(lambda item: item[0].digest(finish_prefetched(item)), prefetched(missing), workers):
+        pass
+    return [entry.digest() for entry in entries]
+
+def transformed_frames(frames, transform):
+    # a FrameSequence of transform(entry) for every frame, repeats of a frame
+    # keep sharing one entry
+    frames = frames if isinstance(frames, FrameSequence) else FrameSequence(frames)
+    done = {}
+    entries = []
+    for entry in frames.entries():
+        if entry not in done:
+            done[entry] = transform(entry)
+        entries.append(done[entry])
+    return FrameSequence.from_entries(entries)
+
+@traced("resize")
+def resize_frames(frames, height, resample=Image.LANCZOS, workers=None, progress=None):
+    w, h = frames[0].size
+    aspect_ratio = h / w
+    new_h = height
+    new_w = int(new_h / aspect_ratio)
+    stack = stack_of(frames)
+    if stack is not None:
+        # every stacked frame is resized once, into a new stack, rendered the
+        # way a transformed frame would be so both paths give the same pixels
+        indices = sorted({entry.index for entry in frames.entries()})
+        origins = [transformed(stack.origin(index), size=(new_w, new_h), resample=resample, reducing_gap=REDUCING_GAP)
+                   for index in indices]
+        resized = FrameStack.empty(len(indices), (new_w, new_h))
+        resized.origins = origins
+        resized_pixels = parallel_map(lambda origin: np.asarray(render_entry(origin)), origins, workers)
+        for k, pixels in enumerate(reported(resized_pixels, progress, len(indices))):
+            resized.pixels[k] = pixels
+        return restacked(frames, resized, {index: k for k, index in enumerate(indices)})
+    return transformed_frames(
+        frames, lambda entry: transformed(entry, size=(new_w, new_h), resample=resample, reducing_gap=REDUCING_GAP))
+
+@traced("crop")
+def crop_frames(frames, crop_box, progress=None):
+    left, top, right, bottom = crop_box
+    stack = stack_of(frames)
+    if stack is not None and 0 <= left < right <= stack.size[0] and 0 <= top < bottom <= stack.size[1]:
+        # a view of the same pixels, nothing is copied
+        origins = [transformed(stack.origin(index), box=crop_box) for index in range(len(stack))]
+        return restacked(frames, FrameStack(stack.pixels[:, top:bottom, left:right], origins))
+    w, h = frames[0].size
+    if stack is None and 0 <= left < right <= w and 0 <= top < bottom <= h:
+        return transformed_frames(frames, lambda entry: transformed(entry, box=crop_box))
+    # parts outside the frame come out transparent black
+    return [f.crop(crop_box) for f in reported(frames, progress)]
+
+def reverse_frames(frames, durations):
+    # a FrameSequence only reorders its entries, no frame is touched
+    return frames[::-1], durations[::-1]
+
+def pendulum_frames(frames, durations):
+    return frames + frames[::-1], durations + durations[::-1]
+
+# TWO ANIMATION OPERATIONS
+def calc_resizing_metrics(w1, h1, w2, h2):
+    new_height = max(h1, h2)
+    if new_height == h1:
+        aspect_ratio = h2 / w2
+        new_width = int(new_height / aspect_ratio)
+        w2 = new_width
+        h2 = new_height
+        is_resizing_1 = False
+    else:
+        aspect_ratio = h1 / w1
+        new_width = int(new_height / aspect_ratio)
+        w1 = new_width
+        h1 = new_height
+        is_resizing_1 = True
+
+    return w1, h1, w2, h2, is_resizing_1
+
+def adjust_frame_durations(d1, d2):
+    # Stretch the shorter animation's durations to the longer one's total.
+    # Frame ends are rounded rather than each duration, so the rounding
+    # leftovers carry over and the totals match exactly.
+    d1 = list(d1)
+    d2 = list(d2)
+    sum1 = sum(d1)
+    sum2 = sum(d2)
+
+    if sum1 > sum2:
+        d2 = stretch_durations(d2, sum1)
+    else:
+        d1 = stretch_durations(d1, sum2)
+
+    return d1, d2
+
+def stretch_durations(durations, total):
+    current = sum(durations)
+    stretched = []
+    elapsed, prev_end = 0, 0
+    for d in durations:
+        elapsed += d
+        int_part, frac_part = custom_round(total * elapsed / current)
+        stretched.append(int(int_part) - prev_end)
+        prev_end = int(int_part)
+    return stretched
+
+@traced("merge")
+def merge_animations(frames1, durations1, frames2, durations2, tick=MERGE_TICK, max_frames=None,
+                     progress=None):
+    # side by side; a single still frame is held for the whole other animation
+    if len(frames1) == 1:
+        durations1 = [sum(durations2)]
+    elif len(frames2) == 1:
+        durations2 = [sum(durations1)]
+    else:
+        durations1, durations2 = adjust_frame_durations(durations1, durations2)
+
+    return merge_images(frames1, durations1, frames2, durations2, tick, max_frames, progress)
+
+def fit_size(size, max_size):
+    # the size Image.thumbnail(max_size) would shrink an image of this size to
+    width, height = size
+    x, y = max_size
+    if x >= width and y >= height:
+        return size
+    aspect = width / height
+    if x / y >= aspect:
+        x = max(min(floor(y * aspect), ceil(y * aspect), key=lambda n: abs(aspect - n / y)), 1)
+    else:
+        y = max(min(floor(x / aspect), ceil(x / aspect), key=lambda n: 0 if n == 0 else abs(aspect - x / n)), 1)
+    return x, y
+
+def snap_bounds(bounds, end, grid):
+    # inner boundaries rounded to the grid; ones that collapse onto their
+    # neighbour are dropped, which folds the sliver between them
+    snapped = [0]
+    for t in bounds:
+        t = int(custom_round(t / grid)[0]) * grid
+        if snapped[-1] < t < end:
+            snapped.append(t)
+    # an end that is off the grid must not leave a sliver either
+    if len(snapped) > 1 and end - snapped[-1] < grid:
+        snapped.pop()
+    snapped.append(end)
+    return snapped
+
+def align_steps(durations1, durations2, tick=MERGE_TICK, max_frames=None):
+    # Output steps for playing both timelines side by side: every frame
+    # boundary of either side starts a step, snapped to a multiple of tick so
+    # no step is shorter than the output format can show. With max_frames the
+    # grid is coarsened until the step count fits. The last step always ends
+    # on the shorter timeline's exact end.
+    ends1 = list(accumulate(durations1))
+    ends2 = list(accumulate(durations2))
+    end = min(ends1[-1], ends2[-1])
+    bounds = sorted(set(ends1) | set(ends2))
+    tick = max(1, tick)
+
+    multiple = 1
+    if max_frames and len(snap_bounds(bounds, end, tick)) - 1 > max_frames:
+        # a grid as long as the whole animation always fits (a single step)
+        low, high = 1, max(1, ceil(end / tick))
+        while low < high:
+            mid = (low + high) // 2
+            if len(snap_bounds(bounds, end, mid * tick)) - 1 <= max_frames:
+                high = mid
+            else:
+                low = mid + 1
+        multiple = low
+    step_bounds = snap_bounds(bounds, end, multiple * tick)
+
+    steps1, steps2, step_durations = [], [], []
+    for start, stop in zip(step_bounds, step_bounds[1:]):
+        # each side shows the frame that is on screen halfway through the step
+        middle = (start + stop) / 2
+        steps1.append(min(bisect_right(ends1, middle), len(ends1) - 1))
+        steps2.append(min(bisect_right(ends2, middle), len(ends2) - 1))
+        step_durations.append(stop - start)
+
+    return steps1, steps2, step_durations
+
+def frame_runs(frames, steps):
+    # [frame index, first step, end step] for every run of steps that shows the
+    # same frame, including repeats of one frame such as a padded still image
+    if isinstance(frames, FrameSequence):
+        key = frames.entry
+    else:
+        key = lambda index: id(frames[index])
+    runs = []
+    for step, index in enumerate(steps):
+        if runs and (runs[-1][0] == index or key(runs[-1][0]) == key(index)):
+            runs[-1][2] = step + 1
+        else:
+            runs.append([index, step, step + 1])
+    return runs
+
+def merge_images(frames1, durations1, frames2, durations2, tick=MERGE_TICK, max_frames=None,
+                 progress=None):
+    # Both sides are resized straight to their part of the final (at most
+    # MERGE_MAX_SIZE) canvas and written into one preallocated frame stack.
+    # Each source frame is resized once and copied into every step it spans.
+    w1, h1 = frames1[0].size
+    w2, h2 = frames2[0].size
+    width1, height1, width2, height2, is_resizing_1 = calc_resizing_metrics(w1, h1, w2, h2)
+    combined_width = width1 + width2
+    out_width, out_height = fit_size((combined_width, height1), (MERGE_MAX_SIZE, MERGE_MAX_SIZE))
+    side_width1 = round(width1 * out_width / combined_width)
+    side_width2 = out_width - side_width1
+    # the shorter side keeps the resize filter it always had, a canvas too
+    # large is shrunk with the filter Image.thumbnail would have used
+    resample = Image.LANCZOS if out_width == combined_width else Image.BICUBIC
+
+    steps1, steps2, merged_durations = align_steps(durations1, durations2, tick, max_frames)
+    # every pixel is written by one of the two sides
+    stack = FrameStack.empty(len(merged_durations), (out_width, out_height)).pixels
+
+    sides = [(frames1, frame_runs(frames1, steps1), (side_width1, out_height), 0),
+             (frames2, frame_runs(frames2, steps2), (side_width2, out_height), side_width1)]
+    done, total = 0, sum(len(runs) for _, runs, _, _ in sides)
+    for frames, runs, size, left in sides:
+        def render(run, frames=frames, size=size):
+            frame = frames[run[0]]
+            if frame.mode != "RGBA":
+                frame = frame.convert("RGBA")
+            if frame.size != size:
+                frame = resize_frame(frame, size, resample)
+            pixels = np.array(frame)
+            # alpha is dropped, as pasting onto an RGB canvas did
+            pixels[..., 3] = 255
+            return run, pixels
+        for (_, start, end), pixels in parallel_map(render, runs):
+            stack[start:end, :, left:left + size[0]] = pixels
+            done += 1
+            if progress is not None:
+                progress(done, total)
+
+    return FrameSequence.from_entries(FrameStack(stack).entries()), merged_durations
+
+def letterbox_frames(frames, container_size, x_offset, progress=None):
+    stack = stack_of(frames)
+    w, h = container_size
+    if stack is not None and stack.size[1] <= h and x_offset + stack.size[0] <= w:
+        # one vectorized copy into a black, opaque stack (alpha is dropped,
+        # as pasting onto an RGB container did)
+        indices = sorted({entry.index for entry in frames.entries()})
+        pixels = stack.pixels if len(indices) == len(stack) else stack.pixels[indices]
+        boxed = FrameStack.zeros(len(indices), container_size)
+        fw, fh = stack.size
+        boxed.pixels[:, :fh, x_offset:x_offset + fw] = pixels
+        boxed.pixels[..., 3] = 255
+        return restacked(frames, boxed, {index: k for k, index in enumerate(indices)})
+    fw, fh = frames[0].size
+    if stack is None and fh <= h and x_offset + fw <= w:
+        return transformed_frames(frames, lambda entry: transformed(entry, canvas=(container_size, (x_offset, 0))))
+    letterboxed = []
+    for f in reported(frames, progress):
+        container = Image.new("RGB", container_size, (0, 0, 0))
+        container.paste(f, (x_offset, 0))
+        letterboxed.append(container.convert("RGBA"))
+    return letterboxed
+
+@traced("concat")
+def concat_animations(frames1, durations1, frames2, durations2, progress=None):
+    # one after the other, both scaled to the taller height and centered
+    w1, h1 = frames1[0].size
+    w2, h2 = frames2[0].size
+
+    width1, height1, width2, height2, is_resizing_1 = calc_resizing_metrics(w1, h1, w2, h2)
+    container_width = max(width1, width2)
+    container_height = height1
+    container_size = (container_width, container_height)
+
+    # progress restarts with each pass
+    if is_resizing_1:
+        if container_width > width2:
+            resized2 = letterbox_frames(frames2, container_size, (container_width - width2) // 2, progress)
+        else:
+            resized2 = frames2
+        resized1 = letterbox_frames(resize_frames(frames1, height1, progress=progress), container_size,
+                                    (container_width - width1) // 2, progress)
+    else:
+        if container_width > width1:
+            resized1 = letterbox_frames(frames1, container_size, (container_width - width1) // 2, progress)
+        else:
+            resized1 = frames1
+        resized2 = letterbox_frames(resize_frames(frames2, height2, progress=progress), container_size,
+                                    (container_width - width2) // 2, progress)
+
+    return FrameSequence(resized1) + resized2, list(durations1) + list(durations2)
+
+# EXPORT
+def chunk_palette(frame):
+    # palette=Image.WEB
+    return frame.convert("RGB").convert("P", palette=Image.ADAPTIVE, dither=Image.NONE)
+
+def frame_sample(frame, pixels):
+    # about pixels RGB pixels of frame, evenly spread over it, as (n, 3)
+    rgb = np.asarray(frame.convert("RGB"))
+    h, w = rgb.shape[:2]
+    step = max(1, round(sqrt(w * h / pixels)))
+    return rgb[::step, ::step].reshape(-1, 3)
+
+def color_histogram(sample):
+    # share of the sample in each of 8 x 8 x 8 color bins
+    bins = (sample >> 5).astype(np.intp)
+    return np.bincount(bins[:, 0] * 64 + bins[:, 1] * 8 + bins[:, 2], minlength=512) / len(sample)
+
+def scene_starts(samples, cut=PALETTE_SCENE_CUT):
+    starts = [0]
+    reference = color_histogram(samples[0])
+    for index in range(1, len(samples)):
+        histogram = color_histogram(samples[index])
+        if np.abs(histogram - reference).sum() > cut:
+            starts.append(index)
+            reference = histogram
+    return starts
+
+def kmeans_colors(colors, sample, rounds):
+    # Lloyd's algorithm started from colors, on an evenly strided subset of sample
+    points = sample[::max(1, len(sample) // PALETTE_KMEANS_SAMPLE)].astype(np.float32)
+    colors = colors.astype(np.float32)
+    for _ in range(rounds):
+        # |point|^2 is the same for every color, so it is left out of the distance
+        nearest = np.argmin((colors ** 2).sum(axis=1) - 2 * points @ colors.T, axis=1)
+        counts = np.bincount(nearest, minlength=len(colors))
+        used = counts > 0
+        for channel in range(3):
+            sums = np.bincount(nearest, points[:, channel], minlength=len(colors))
+            colors[used, channel] = sums[used] / counts[used]
+    return np.clip(np.rint(colors), 0, 255).astype(np.uint8)
+
+def sampled_palette(sample, kmeans=0):
+    # a median cut palette image for an (n, 3) pixel sample
+    sample = sample[::max(1, len(sample) // PALETTE_SAMPLE_PIXELS)]
+    palette = Image.fromarray(np.ascontiguousarray(sample).reshape(-1, 1, 3)).quantize(method=Image.Quantize.MEDIANCUT)
+    if kmeans:
+        colors = np.array(palette.getpalette("RGB"), np.uint8).reshape(-1, 3)
+        palette = Image.new("P", (1, 1))
+        palette.putpalette(kmeans_colors(colors, sample, kmeans).ravel().tolist())
+    return palette
+
+class ExportCache:
+    # What GIF export derives from frames, kept for the next export: pixel
+    # samples, palettes and every frame's delta against the frame before it.
+    # Keys are built from frame content hashes, so entries stay valid through
+    # any edit. The least recently used entries go first.
+    def __init__(self, max_bytes=EXPORT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        self.items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, nbytes):
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.nbytes -= old[1]
+        self.items[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and len(self.items) > 1:
+            _, (_, evicted) = self.items.popitem(last=False)
+            self.nbytes -= evicted
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+export_cache = ExportCache()
+
+def chunk_palettes(frames, chunk_size):
+    # [(start, end, palette image)] with a palette from the first of every
+    # chunk_size frames, cached by that frame's content hash
+    starts = range(0, len(frames), chunk_size)
+    keys = [("chunk palette", frames.entry(start).digest()) for start in starts]
+    palettes = [export_cache.get(key) for key in keys]
+    missing = [k for k, palette in enumerate(palettes) if palette is None]
+    for k, palette in zip(missing, parallel_map(lambda k: chunk_palette(frames[starts[k]]), missing)):
+        palettes[k] = palette
+        export_cache.put(keys[k], palette, 768)
+    return [(start, min(start + chunk_size, len(frames)), palette) for start, palette in zip(starts, palettes)]
+
+def frame_palettes(frames, mode, kmeans=0, progress=None):
+    # [(start, end, palette image)] covering all frames: one palette for the
+    # whole animation, or one per scene with mode "scenes". Samples are cached
+    # per frame and palettes per scene (by the hashes of its frames, in
+    # order), so after a small edit the scenes it didn't touch get the same
+    # palettes and their cached deltas still apply; a cached palette is
+    # always the one the scene would get in a fresh export.
+    digests = [frames.entry(i).digest() for i in range(len(frames))]
+    # a power of two, so that adding or removing a few frames keeps the samples
+    pixels = max(PALETTE_FRAME_SAMPLE, PALETTE_SAMPLE_PIXELS // len(frames))
+    pixels = 1 << (pixels.bit_length() - 1)
+    with tracer.span("palette", frames=len(frames)):
+        samples = [export_cache.get(("sample", digest, pixels)) for digest in digests]
+        missing = [i for i, sample in enumerate(samples) if sample is None]
+        sampled = parallel_map(lambda i: frame_sample(frames[i], pixels), missing)
+        for i, sample in zip(missing, reported(sampled, progress, len(missing))):
+            samples[i] = sample
+            export_cache.put(("sample", digests[i], pixels), sample, sample.nbytes)
+        bounds = (scene_starts(samples) if mode == "scenes" else [0]) + [len(frames)]
+        palettes = []
+        for start, end in zip(bounds, bounds[1:]):
+            scene = hashlib.blake2b(b"".join(digests[start:end]), digest_size=16).digest()
+            key = ("scene palette", mode, kmeans, pixels, scene)
+            palette = export_cache.get(key)
+            if palette is None:
+                palette = sampled_palette(np.concatenate(samples[start:end]), kmeans)
+                export_cache.put(key, palette, 768)
+            palettes.append((start, end, palette))
+    return palettes
+
+def gif_palettes(frames, profile, progress=None):
+    if profile["gif_palette"] == "first":
+        return chunk_palettes(frames, profile["gif_palette_chunk"])
+    return frame_palettes(frames, profile["gif_palette"], profile["gif_kmeans"], progress)
+
+def ordered_dither(rgb):
+    # Adds a 4x4 Bayer pattern, so quantizing without dithering leaves a
+    # fixed pattern: unlike error diffusion it doesn't move from frame to
+    # frame, which keeps GIF frame deltas small.
+    pixels = np.asarray(rgb, np.int16)
+    h, w = pixels.shape[:2]
+    pattern = ((BAYER_4X4 * 2 + 1 - 16) * ORDERED_DITHER_STRENGTH // 32).astype(np.int16)
+    offsets = np.tile(pattern, (ceil(h / 4), ceil(w / 4)))[:h, :w, None]
+    return Image.fromarray(np.clip(pixels + offsets, 0, 255).astype(np.uint8))
+
+def packed_colors(rgb):
+    # an RGB image as one 0xXXBBGGRR integer per pixel, cheap to compare
+    w, h = rgb.size
+    return np.frombuffer(rgb.tobytes("raw", "RGBX"), np.uint32).reshape(h, w)
+
+def quantize_unit(frames, indices, palettes, dither=Image.Dither.FLOYDSTEINBERG):
+    # (index, delta) for frames[index] quantized with palettes[index], for
+    # each index: the whole frame for the first one, otherwise its gif_delta
+    # over frames[index - 1], or False if no source color changed. Only the
+    # deltas leave the worker, the source colors are compared here. Pillow
+    # has no ordered dithering for palettes, Image.Dither.ORDERED is done here.
+    quantized = []
+    previous_index = previous_pixels = None
+    for index in indices:
+        with tracer.span("quantize", frame=index):
+            rgb = frames[index].convert("RGB")
+            if dither == Image.Dither.ORDERED:
+                frame = ordered_dither(rgb).quantize(palette=palettes[index], dither=Image.Dither.NONE)
+            else:
+                frame = rgb.quantize(palette=palettes[index], dither=dither)
+            pixels = packed_colors(rgb)
+            if index == 0:
+                delta = (frame, (0, 0), None)
+            else:
+                if previous_index != index - 1:
+                    previous_pixels = packed_colors(frames[index - 1].convert("RGB"))
+                changed = pixels != previous_pixels
+                delta = gif_delta(frame, changed) if changed.any() else False
+            previous_index, previous_pixels = index, pixels
+            quantized.append((index, delta))
+    return quantized
+
+def quantize_frames(frames, indices, palettes, workers=None, dither=Image.Dither.FLOYDSTEINBERG,
+                    unit_size=GIF_PALETTE_CHUNK):
+    # quantize_unit for the given (ascending) indices, yielded in order. The
+    # work is split into units sized to keep every worker busy, and units
+    # are small enough that no more than QUANTIZE_WINDOW frames (or two per
+    # worker) are in flight; lazy frames are decoded by the unit that
+    # quantizes them. Each frame has its palette ahead of time, so the output
+    # never depends on the core count.
+    workers = workers or WORKERS
+    unit_size = max(1, min(unit_size, ceil(len(indices) / (workers * 4)), QUANTIZE_WINDOW // (2 * workers)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for start in range(0, len(indices), unit_size):
+            pending.append(pool.submit(quantize_unit, frames, indices[start:start + unit_size], palettes, dither))
+            while len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def gif_delta(frame, changed):
+    # The part of frame inside the box around the changed pixels. Unchanged
+    # pixels inside the box are set to a palette index no changed pixel uses,
+    # which is then marked transparent, so what is on screen stays. Pixels
+    # are compared before quantizing: dithering spreads any change over the
+    # rest of the frame, the source pixels around it stay the same.
+    rows = np.flatnonzero(changed.any(axis=1))
+    cols = np.flatnonzero(changed.any(axis=0))
+    box = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+    changed = changed[box[1]:box[3], box[0]:box[2]]
+    # with next to nothing unchanged, transparency would only add noise
+    if changed.mean() > 0.9:
+        return frame.crop(box), box[:2], None
+    indices = np.array(frame.crop(box))
+    free = np.flatnonzero(np.bincount(indices[changed], minlength=256) == 0)
+    if not len(free):
+        return frame.crop(box), box[:2], None
+
+    transparency = int(free[0])
+    indices[~changed] = transparency
+    delta = Image.fromarray(indices)
+    palette = frame.getpalette("RGB")
+    delta.putpalette(palette + [0] * (768 - len(palette)))
+    return delta, box[:2], transparency
+
+def write_gif(fp, frames, durations, loop=0, progress=None, profile=EXPORT_PROFILES[DEFAULT_EXPORT_PROFILE]):
+    # Writes quantized frames as they come instead of handing Pillow the whole
+    # list. The first frame's palette is the global color table, every later
+    # frame carries its own and only covers what changed since the frame
+    # before it, which stays on screen underneath (disposal 1). Identical
+    # frames are folded, so each one is held back until the next one arrives.
+    # Every frame's delta is cached under its palette and the content hashes
+    # of the frame and the one before it: exporting again after an edit only
+    # quantizes the frames whose pixels, palette or predecessor changed.
+    frames = frames if isinstance(frames, FrameSequence) else FrameSequence(frames)
+    digests = frame_digests(frames)
+    dither = profile["gif_dither"]
+    palettes, palette_keys = [], []
+    # progress restarts once the frames are sampled
+    for start, end, palette in gif_palettes(frames, profile, progress):
+        key = hashlib.blake2b(repr((dither, ORDERED_DITHER_STRENGTH)).encode() + bytes(palette.getpalette()))
+        palettes += [palette] * (end - start)
+        palette_keys += [key.digest()] * (end - start)
+
+    missing = []
+    previous = None
+    for index, digest in enumerate(digests):
+        if digest != previous:
+            if export_cache.get(("gif delta", palette_keys[index], previous, digest)) is None:
+                missing.append(index)
+            previous = digest
+    quantized = quantize_frames(frames, missing, palettes, dither=dither, unit_size=profile["gif_palette_chunk"])
+    ready = next(quantized, None)
+
+    held = None
+    held_index = 0
+    previous = None
+    for index, duration in enumerate(reported(durations, progress)):
+        digest = digests[index]
+        if held is not None and digest == previous:
+            held[3] += duration
+            continue
+        key = ("gif delta", palette_keys[index], previous, digest)
+        delta = export_cache.get(key)
+        if delta is None:
+            while ready is not None and ready[0] < index:
+                ready = next(quantized, None)
+            if ready is not None and ready[0] == index:
+                _, delta = ready
+            else:
+                # not planned: the frame before it turned out to look the same as its own predecessor
+                _, delta = quantize_unit(frames, [index], palettes, dither)[0]
+            # writing trims the palette of the image in place, the cache keeps its own copy
+            export_cache.put(key, delta and (delta[0].copy(), *delta[1:]), delta and delta[0].width * delta[0].height)
+        else:
+            delta = delta and (delta[0].copy(), *delta[1:])
+        if delta is False:
+            held[3] += duration
+            continue
+        if held is not None:
+            with tracer.span("encode", frame=held_index):
+                write_gif_frame(fp, *held, loop, fp.tell() == 0, profile["gif_optimize"])
+        held = [*delta, duration]
+        held_index = index
+        previous = digest
+    with tracer.span("encode", frame=held_index):
+        write_gif_frame(fp, *held, loop, fp.tell() == 0, profile["gif_optimize"])
+    fp.write(b";")
+
+def write_gif_frame(fp, frame, offset, transparency, duration, loop, first, optimize=True):
+    info = {"optimize": optimize, "loop": loop}
+    if transparency is not None:
+        info["transparency"] = transparency
+    # getheader also trims unused palette entries from the frame, in place,
+    # and moves the transparent index along with them
+    header, _ = GifImagePlugin.getheader(frame, info=info)
+    if first:
+        for block in header:
+            fp.write(block)
+    params = {"duration": duration, "disposal": 1, "include_color_table": not first}
+    if "transparency" in info:
+        params["transparency"] = info["transparency"]
+    for block in GifImagePlugin.getdata(frame, offset, **params):
+        fp.write(block)
+
+def write_webp(fp, frames, durations, loop=0, progress=None, profile=EXPORT_PROFILES[DEFAULT_EXPORT_PROFILE]):
+    # Same encoder and defaults Pillow's save_all uses, fed one frame at a
+    # time; only the compressed frames are kept until the file is assembled.
+    # The encoder is private to Pillow, so this is only done with the
+    # versions in WEBP_STREAM_PILLOW; others (or a Pillow built without
+    # WebP) go through save_all.
+    version = tuple(int(v) for v in PIL.__version__.split(".")[:2])
+    if not WEBP_STREAM_PILLOW[0] <= version < WEBP_STREAM_PILLOW[1]:
+        save_webp(fp, frames, durations, loop, progress, profile)
+        return
+    try:
+        from PIL import _webp
+    except ImportError:
+        save_webp(fp, frames, durations, loop, progress, profile)
+        return
+    lossless = profile["webp_lossless"]
+    # keyframe spacing as Pillow picks it
+    kmin, kmax = (9, 17) if lossless else (3, 5)
+    encoder = _webp.WebPAnimEncoder(frames[0].size, 0, loop, profile["webp_minimize_size"], kmin, kmax, False, False)
+    options = (lossless, profile["webp_quality"], 100, profile["webp_method"])
+    timestamp = 0
+    for index, (frame, duration) in enumerate(zip(reported(rendered_frames(frames), progress, len(frames)), durations)):
+        if frame.mode not in ("RGBA", "RGB"):
+            frame = frame.convert("RGBA")
+        with tracer.span("encode", frame=index):
+            encoder.add(frame.getim(), timestamp, *options)
+        timestamp += duration
+    encoder.add(None, timestamp, *options)
+    with tracer.span("assemble"):
+        data = encoder.assemble("", "", "")
+    if data is None:
+        raise OSError("cannot write file as WebP (encoder returned None)")
+    fp.write(data)
+
+def save_webp(fp, frames, durations, loop=0, progress=None, profile=EXPORT_PROFILES[DEFAULT_EXPORT_PROFILE]):
+    # write_webp through Pillow's public API, holding every frame at once
+    frames = list(reported(rendered_frames(frames), progress, len(frames)))
+    frames[0].save(fp, format="WEBP", save_all=True, append_images=frames[1:], duration=list(durations), loop=loop,
+                   background=(0, 0, 0, 0),
+                   lossless=profile["webp_lossless"], quality=profile["webp_quality"], method=profile["webp_method"],
+                   minimize_size=profile["webp_minimize_size"])
+
+class ExportResult:
+    # what an export produced: file size, encode time and folded duplicates
+    def __init__(self, path, removed, seconds, profile=DEFAULT_EXPORT_PROFILE):
+        self.path = path
+        self.removed = removed
+        self.seconds = seconds
+        self.profile = profile
+        self.nbytes = os.path.getsize(path)
+
+    def summary(self):
+        text = f"{self.nbytes / 1024:.0f} KB in {self.seconds:.2f} s ({self.profile})"
+        if self.removed:
+            text += f", {self.removed} duplicate frames merged"
+        return text
+
+@traced("export")
+def export_animation(path, frames, durations, coalesce=True, profile=DEFAULT_EXPORT_PROFILE, progress=None,
+                     dither=None):
+    # Frames are produced, encoded and written one window at a time, so a
+    # lazily loaded animation never has to be decoded into memory as a whole.
+    # dither, one of GIF_DITHERS, overrides the profile's for GIFs.
+    start = time.perf_counter()
+    ext = os.path.splitext(path)[-1].lower()
+    if ext not in EXPORT_EXTENSIONS:
+        raise ValueError("Only .gif or .webp extensions are supported.")
+    settings = EXPORT_PROFILES[profile]
+    if dither is not None:
+        settings = dict(settings, gif_dither=dither)
+
+    removed = 0
+    if coalesce:
+        frames, durations, removed = coalesce_frames(frames, durations)
+
+    # Written next to path and moved over it once complete: the file being
+    # replaced may be the one lazy frames are still decoded from, and a failed
+    # or cancelled export leaves it as it was.
+    fd, temp_path = tempfile.mkstemp(prefix=".aie-", suffix=ext, dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            if ext == ".webp" and len(frames) == 1:
+                frames[0].save(fp, duration=durations, loop=0, format="WEBP", method=settings["webp_still_method"],
+                               quality=settings["webp_quality"], lossless=settings["webp_lossless"])
+            elif ext == ".webp":
+                write_webp(fp, frames, durations, progress=progress, profile=settings)
+            else:
+                write_gif(fp, frames, durations, progress=progress, profile=settings)
+        os.chmod(temp_path, file_mode(path))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return ExportResult(path, removed, time.perf_counter() - start, profile)
+
+def file_mode(path):
+    # permissions for a file written to path: the ones of the file it
+    # replaces, or what creating it would have given (mkstemp makes it 0600)
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
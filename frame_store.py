@@ -0,0 +1,557 @@
+import hashlib
+import os
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableSequence
+import numpy as np
+from PIL import Image
+from tracing import tracer
+
+# Byte budget for decoded RGBA frames kept around by the shared LRU cache.
+# Override with AIE_FRAME_CACHE_MB=<megabytes>.
+FRAME_CACHE_BYTES = int(os.environ.get("AIE_FRAME_CACHE_MB", "512")) * 1024 * 1024
+# Decode whole animations into one contiguous array (see FrameStack) instead
+# of on demand. Enable with AIE_FRAME_STACK=1.
+FRAME_STACK = os.environ.get("AIE_FRAME_STACK", "0") == "1"
+# Frame stacks larger than this live in a memory-mapped scratch file instead
+# of RAM. Defaults to the frame cache budget: animations too large for the
+# cache are decoded into a stack, since decoding them lazily again and again
+# is slow for anything but file order (GIF and WEBP seek back from frame 0).
+# Override with AIE_STACK_RAM_MB=<megabytes> and AIE_SCRATCH_DIR=<directory>.
+STACK_RAM_BYTES = int(os.environ.get("AIE_STACK_RAM_MB", FRAME_CACHE_BYTES // (1024 * 1024))) * 1024 * 1024
+SCRATCH_DIR = os.environ.get("AIE_SCRATCH_DIR") or None
+
+def frame_nbytes(frame):
+    w, h = frame.size
+    return w * h * len(frame.getbands())
+
+def frame_digest(frame):
+    # content hash, equal only for frames with identical pixels
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{frame.mode} {frame.size}".encode())
+    h.update(frame.tobytes())
+    return h.digest()
+
+class FrameCache:
+    def __init__(self, max_bytes=FRAME_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            frame = self._items.get(key)
+            if frame is not None:
+                self._items.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        size = frame_nbytes(frame)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= frame_nbytes(self._items.pop(key))
+            self._items[key] = frame
+            self.nbytes += size
+            # always keep the newest frame, even if it alone is over budget
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= frame_nbytes(evicted)
+
+    def offer(self, key, frame):
+        # like put, but never evicts anything to make room
+        with self._lock:
+            if key in self._items or self.nbytes + frame_nbytes(frame) > self.max_bytes:
+                return False
+        self.put(key, frame)
+        return True
+
+    def discard(self, key):
+        with self._lock:
+            frame = self._items.pop(key, None)
+            if frame is not None:
+                self.nbytes -= frame_nbytes(frame)
+
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.nbytes > self.max_bytes and self._items:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= frame_nbytes(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+frame_cache = FrameCache()
+
+class FrameSource:
+    # An opened animated image file that decodes single frames on request
+    def __init__(self, file_path, n_frames=None):
+        # n_frames: the count if known, GIFs are read to the end to count them
+        self.file_path = file_path
+        self.img = Image.open(file_path)
+        self.n_frames = n_frames or getattr(self.img, "n_frames", 1)
+        self.size = self.img.size
+        self._lock = threading.Lock()
+
+    def decode(self, index):
+        with self._lock, tracer.span("decode", frame=index):
+            self.img.seek(index)
+            return self.img.convert("RGBA")
+
+    def frames(self, decode=True):
+        # One sequential pass over the file: (index, duration, RGBA frame, or
+        # None without decode) for every frame. The lock is taken per frame,
+        # so a pass needs a FrameSource of its own: a decode() in between
+        # would send every seek back to the start.
+        for index in range(self.n_frames):
+            with self._lock, tracer.span("decode", frame=index):
+                self.img.seek(index)
+                self.img.load()
+                duration = self.img.info.get("duration", 100)
+                frame = self.img.convert("RGBA") if decode else None
+            yield index, duration, frame
+
+    def close(self):
+        with self._lock:
+            self.img.close()
+
+class LazyFrame:
+    # A frame that lives in a FrameSource and is decoded on first use
+    __slots__ = ("source", "index", "_digest", "__weakref__")
+
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+        self._digest = None
+
+    @property
+    def size(self):
+        return self.source.size
+
+    def load(self):
+        frame = frame_cache.get(self)
+        if frame is None:
+            frame = self.source.decode(self.index)
+            frame_cache.put(self, frame)
+        return frame
+
+    def digest(self, frame=None):
+        # frame: the pixels of this frame, if the caller has them already
+        if self._digest is None:
+            self._digest = frame_digest(self.load() if frame is None else frame)
+        return self._digest
+
+class StoredFrame:
+    # A frame that only exists in memory, e.g. the result of a crop or resize
+    __slots__ = ("image", "_digest", "__weakref__")
+
+    def __init__(self, image):
+        self.image = image
+        self._digest = None
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def load(self):
+        return self.image
+
+    def digest(self, frame=None):
+        if self._digest is None:
+            self._digest = frame_digest(self.image)
+        return self._digest
+
+def resample_frame(frame, size, resample=Image.LANCZOS, box=None, reducing_gap=None):
+    # Opaque RGBA frames (most GIF/WEBP content) skip Pillow's premultiplied
+    # alpha round trip, which costs two extra full-resolution passes.
+    if frame.mode == "RGBA" and frame.getchannel("A").getextrema() == (255, 255):
+        return frame.convert("RGB").resize(size, resample, box, reducing_gap).convert("RGBA")
+    return frame.resize(size, resample, box, reducing_gap)
+
+class TransformedFrame:
+    # Another entry cropped to box (in its pixels, possibly fractional),
+    # scaled to scaled_size and, with a canvas of (size, offset), placed on a
+    # black canvas. The original stays untouched; the frame is rendered in one
+    # resampling pass when first used and then cached like a decoded frame.
+    __slots__ = ("base", "box", "scaled_size", "resample", "reducing_gap", "canvas", "_digest", "__weakref__")
+
+    def __init__(self, base, box, scaled_size, resample=Image.LANCZOS, reducing_gap=None, canvas=None):
+        self.base = base
+        self.box = box
+        self.scaled_size = scaled_size
+        self.resample = resample
+        self.reducing_gap = reducing_gap
+        self.canvas = canvas
+        self._digest = None
+
+    @property
+    def size(self):
+        return self.canvas[0] if self.canvas is not None else self.scaled_size
+
+    def load(self, base_frame=None):
+        # base_frame: the base's pixels, if the caller has loaded them already
+        frame = frame_cache.get(self)
+        if frame is None:
+            with tracer.span("render"):
+                frame = self.render(base_frame)
+            frame_cache.put(self, frame)
+        return frame
+
+    def render(self, base_frame=None):
+        frame = self.base.load() if base_frame is None else base_frame
+        box = self.box
+        if box != (0, 0, *frame.size) or self.scaled_size != frame.size:
+            if all(float(v).is_integer() for v in box) and self.scaled_size == (box[2] - box[0], box[3] - box[1]):
+                frame = frame.crop(tuple(int(v) for v in box))
+            else:
+                frame = resample_frame(frame, self.scaled_size, self.resample, box, self.reducing_gap)
+        if self.canvas is not None:
+            # alpha is dropped, as pasting onto an RGB container always did
+            container = Image.new("RGB", self.canvas[0], (0, 0, 0))
+            container.paste(frame, self.canvas[1])
+            frame = container.convert("RGBA")
+        return frame
+
+    def digest(self, frame=None):
+        # frame: the pixels of this frame, if the caller has them already
+        if self._digest is None:
+            self._digest = frame_digest(self.load() if frame is None else frame)
+        return self._digest
+
+def transformed(entry, box=None, size=None, resample=None, reducing_gap=None, canvas=None):
+    # entry cropped to box (default: all of it), scaled to size (default: the
+    # box size) and placed on canvas. A transform of a transformed entry is
+    # folded into one transform of the original, so the frame is still
+    # resampled only once; crops keep the entry's resampling filter.
+    if isinstance(entry, TransformedFrame) and entry.canvas is None:
+        w, h = entry.scaled_size
+        left, top, right, bottom = box if box is not None else (0, 0, w, h)
+        x0, y0, x1, y1 = entry.box
+        sx, sy = (x1 - x0) / w, (y1 - y0) / h
+        base = entry.base
+        base_box = (x0 + left * sx, y0 + top * sy, x0 + right * sx, y0 + bottom * sy)
+        if resample is None:
+            resample, reducing_gap = entry.resample, entry.reducing_gap
+    else:
+        base = entry
+        left, top, right, bottom = base_box = box if box is not None else (0, 0, *entry.size)
+    size = size if size is not None else (right - left, bottom - top)
+    if base_box == (0, 0, *base.size) and size == base.size and canvas is None:
+        return base
+    return TransformedFrame(base, base_box, size, Image.LANCZOS if resample is None else resample, reducing_gap,
+                            canvas)
+
+def remove_scratch(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def scratch_array(shape):
+    # A zero-filled uint8 array in a temporary file, paged in and out by the
+    # OS. The file goes away with the array.
+    fd, path = tempfile.mkstemp(prefix="aie-", suffix=".frames", dir=SCRATCH_DIR)
+    os.close(fd)
+    try:
+        pixels = np.memmap(path, np.uint8, "w+", shape=shape)
+    except BaseException:
+        remove_scratch(path)
+        raise
+    # POSIX lets the mapped file be unlinked right away, Windows only once
+    # it is unmapped
+    remove_scratch(path)
+    if os.path.exists(path):
+        weakref.finalize(pixels, remove_scratch, path)
+    return pixels
+
+class FrameStack:
+    # Frames of one size in a single (N, H, W, 4) uint8 RGBA array. The array
+    # may be a view of another stack's, e.g. a crop, so bulk edits are numpy
+    # slices and vectorized writes rather than a loop over PIL images.
+    # origins[i], if given, is the transform of an earlier frame that frame i
+    # was cropped out of or rendered from, so later crops and resizes fold
+    # into it exactly as they do for transformed frames.
+    def __init__(self, pixels, origins=None):
+        self.pixels = pixels
+        self.origins = origins
+
+    @classmethod
+    def empty(cls, count, size):
+        w, h = size
+        shape = (count, h, w, 4)
+        if count * h * w * 4 > STACK_RAM_BYTES:
+            return cls(scratch_array(shape))
+        return cls(np.empty(shape, np.uint8))
+
+    @classmethod
+    def zeros(cls, count, size):
+        stack = cls.empty(count, size)
+        if not stack.on_disk:
+            # scratch files start out zero-filled
+            stack.pixels.fill(0)
+        return stack
+
+    def __len__(self):
+        return len(self.pixels)
+
+    @property
+    def size(self):
+        return self.pixels.shape[2], self.pixels.shape[1]
+
+    @property
+    def on_disk(self):
+        # slices of a memmap (crops) are memmaps too
+        return isinstance(self.pixels, np.memmap)
+
+    def entries(self):
+        return [StackFrame(self, i) for i in range(len(self.pixels))]
+
+    def origin(self, index):
+        # frame index as the entry to fold the next transform into
+        if self.origins is not None:
+            return self.origins[index]
+        return StackFrame(self, index)
+
+class StackFrame:
+    # One frame of a FrameStack
+    __slots__ = ("stack", "index", "_digest", "__weakref__")
+
+    def __init__(self, stack, index):
+        self.stack = stack
+        self.index = index
+        self._digest = None
+
+    @property
+    def size(self):
+        return self.stack.size
+
+    @property
+    def pixels(self):
+        return self.stack.pixels[self.index]
+
+    def load(self):
+        # shares memory with the stack unless the frame is a strided view
+        return Image.fromarray(self.pixels)
+
+    def digest(self, frame=None):
+        # frame: the pixels of this frame, if the caller has them already
+        if self._digest is None:
+            self._digest = frame_digest(self.load() if frame is None else frame)
+        return self._digest
+
+def stack_of(frames):
+    # the FrameStack every frame of a FrameSequence lives in, or None
+    if not isinstance(frames, FrameSequence) or not len(frames):
+        return None
+    stack = getattr(frames.entry(0), "stack", None)
+    if stack is None or not all(getattr(e, "stack", None) is stack for e in frames.entries()):
+        return None
+    return stack
+
+def restacked(frames, stack, indices=None):
+    # The frames of a stack-backed sequence moved onto another stack, where
+    # indices maps old frame indices to new ones (default: unchanged). Repeats
+    # of a frame keep sharing one entry.
+    moved = {}
+    entries = []
+    for entry in frames.entries():
+        if entry.index not in moved:
+            index = entry.index if indices is None else indices[entry.index]
+            moved[entry.index] = StackFrame(stack, index)
+        entries.append(moved[entry.index])
+    return FrameSequence.from_entries(entries)
+
+def as_entry(frame):
+    if isinstance(frame, (LazyFrame, StoredFrame, StackFrame, TransformedFrame)):
+        return frame
+    return StoredFrame(frame)
+
+class FrameSequence(MutableSequence):
+    # List-like timeline of frames: an array of ids into a pool of unique frame
+    # entries. Indexing hands out PIL images, decoding lazy frames on demand;
+    # structural edits (reverse, repeat, move, delete) are integer array
+    # operations and never touch pixels. Entries no longer on the timeline
+    # leave the pool right away, so their memory can be freed.
+    def __init__(self, frames=()):
+        self._pool = []
+        self._slots = {}
+        self._ids = np.empty(0, np.intp)
+        if isinstance(frames, FrameSequence):
+            self._pool = list(frames._pool)
+            self._slots = dict(frames._slots)
+            self._ids = frames._ids.copy()
+        else:
+            self._ids = self._intern(as_entry(f) for f in frames)
+
+    @classmethod
+    def open(cls, file_path, prefill=True, digests=False, stack=None, progress=None):
+        entries, durations = [], []
+        for entry, duration in cls.read(file_path, prefill, digests, stack, progress):
+            entries.append(entry)
+            durations.append(duration)
+        return cls.from_entries(entries), durations
+
+    @staticmethod
+    def read(file_path, prefill=True, digests=False, stack=None, progress=None):
+        # Yields (entry, duration) for every frame as the one decode pass
+        # reaches it, so the start of a long file can be shown while the rest
+        # is still loading. Lazy frames keep what fits in the cache so short
+        # files never need to be decoded twice; stacked ones are copied into
+        # the stack. With digests, frames are hashed while they are decoded
+        # anyway and repeats of a frame anywhere in the file share one entry.
+        # progress(done, total) is called for every frame.
+        source = FrameSource(file_path)
+        if stack is None:
+            w, h = source.size
+            stack = FRAME_STACK or source.n_frames * w * h * 4 > frame_cache.max_bytes
+        if stack:
+            frames = FrameStack.empty(source.n_frames, source.size)
+            scanner = source
+        else:
+            # a pass of its own, frames may be decoded from source meanwhile
+            scanner = FrameSource(file_path, source.n_frames)
+        first = {}
+        yielded = False
+        with tracer.span("load", frames=source.n_frames):
+            try:
+                for index, duration, frame in scanner.frames(decode=stack or prefill or digests):
+                    if stack:
+                        frames.pixels[index] = np.asarray(frame)
+                        entry = StackFrame(frames, index)
+                    else:
+                        entry = LazyFrame(source, index)
+                    if digests:
+                        entry._digest = frame_digest(frame)
+                        entry = first.setdefault(entry._digest, entry)
+                    if prefill and not stack:
+                        frame_cache.offer(entry, frame)
+                    if progress is not None:
+                        progress(index + 1, source.n_frames)
+                    yielded = True
+                    yield entry, duration
+            finally:
+                scanner.close()
+                # lazy frames handed out so far, even by a cancelled load,
+                # keep decoding from source
+                if stack or not yielded:
+                    source.close()
+
+    @classmethod
+    def from_entries(cls, entries):
+        seq = cls()
+        seq._ids = seq._intern(entries)
+        return seq
+
+    def _intern(self, entries):
+        # pool ids for entries, adding the ones not in the pool yet
+        ids = []
+        for entry in entries:
+            slot = self._slots.get(entry)
+            if slot is None:
+                slot = self._slots[entry] = len(self._pool)
+                self._pool.append(entry)
+            ids.append(slot)
+        return np.array(ids, np.intp)
+
+    def _prune(self):
+        # drop pool entries the timeline no longer uses
+        used = np.bincount(self._ids, minlength=len(self._pool)) > 0
+        if used.all():
+            return
+        remap = np.cumsum(used) - 1
+        self._pool = [entry for entry, keep in zip(self._pool, used) if keep]
+        self._slots = {entry: slot for slot, entry in enumerate(self._pool)}
+        self._ids = remap[self._ids]
+
+    def _derived(self, ids):
+        # a new sequence over (a copy of) this pool
+        seq = FrameSequence()
+        seq._pool = list(self._pool)
+        seq._slots = dict(self._slots)
+        seq._ids = ids
+        seq._prune()
+        return seq
+
+    def entry(self, index):
+        return self._pool[self._ids[index]]
+
+    def entries(self):
+        pool = self._pool
+        return [pool[i] for i in self._ids.tolist()]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._derived(self._ids[index].copy())
+        return self._pool[self._ids[index]].load()
+
+    def __setitem__(self, index, frame):
+        if isinstance(index, slice):
+            ids = self._intern(as_entry(f) for f in frame)
+            start, stop, step = index.indices(len(self._ids))
+            if step == 1:
+                stop = max(start, stop)
+                self._ids = np.concatenate((self._ids[:start], ids, self._ids[stop:]))
+            else:
+                self._ids[index] = ids
+        else:
+            self._ids[index] = self._intern([as_entry(frame)])[0]
+        self._prune()
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            index = range(*index.indices(len(self._ids)))
+        self._ids = np.delete(self._ids, index)
+        self._prune()
+
+    def __iter__(self):
+        pool = self._pool
+        for i in self._ids.tolist():
+            yield pool[i].load()
+
+    def __mul__(self, n):
+        return self._derived(np.tile(self._ids, n))
+
+    def __add__(self, other):
+        seq = self.copy()
+        seq.extend(other)
+        return seq
+
+    def insert(self, index, frame):
+        index = max(-len(self._ids), min(index, len(self._ids)))
+        self._ids = np.insert(self._ids, index, self._intern([as_entry(frame)]))
+
+    def extend(self, frames):
+        if isinstance(frames, FrameSequence):
+            frames = frames.entries()
+        else:
+            frames = [as_entry(f) for f in frames]
+        self._ids = np.concatenate((self._ids, self._intern(frames)))
+
+    def move(self, positions, insert_pos):
+        # moves the frames at positions (ascending) to start at insert_pos of
+        # the timeline that is left without them
+        positions = np.asarray(positions, np.intp)
+        rest = np.delete(self._ids, positions)
+        self._ids = np.insert(rest, insert_pos, self._ids[positions])
+
+    def reverse(self):
+        self._ids = self._ids[::-1].copy()
+
+    def copy(self):
+        return FrameSequence(self)
+
+    def clear(self):
+        self._pool = []
+        self._slots = {}
+        self._ids = np.empty(0, np.intp)
@@ -0,0 +1,213 @@
+import os
+from frame_store import StoredFrame, StackFrame, TransformedFrame, frame_nbytes
+
+# Pixel memory the undo/redo history may keep alive on its own.
+# Override with AIE_HISTORY_MB=<megabytes>.
+HISTORY_BYTES = int(os.environ.get("AIE_HISTORY_MB", "512")) * 1024 * 1024
+HISTORY_LIMIT = 50
+
+def held_frames(entries):
+    # {frame: bytes} for the in-memory frames entries keep alive
+    held = {}
+    pending = list(entries)
+    while pending:
+        entry = pending.pop()
+        # a transformed frame holds no pixels of its own, only its original
+        while isinstance(entry, TransformedFrame):
+            entry = entry.base
+        # stack frames are looked up by position, entries for one may differ
+        key = (entry.stack, entry.index) if isinstance(entry, StackFrame) else entry
+        if key in held:
+            continue
+        held[key] = 0
+        if isinstance(entry, StoredFrame):
+            held[key] = frame_nbytes(entry.image)
+        elif isinstance(entry, StackFrame):
+            # frames in a scratch file cost disk space, not memory, and a
+            # cropped stack's frames are views of the frames it came from
+            if not entry.stack.on_disk and entry.stack.pixels.base is None:
+                held[key] = entry.pixels.nbytes
+            # stacked edits keep the frames they were made from
+            if entry.stack.origins is not None:
+                pending.append(entry.stack.origins[entry.index])
+    return held
+
+def held_bytes(entries, shared=()):
+    # bytes of in-memory frames in entries, not counting the ones in shared
+    shared = held_frames(shared)
+    return sum(nbytes for key, nbytes in held_frames(entries).items() if key not in shared)
+
+# Commands only store what they need to go back and forth: indices,
+# durations and references to (shared, immutable) frame entries. The
+# MainDropLabel primitives they call keep the timeline model in sync.
+class Command:
+    # pixel bytes kept alive while the command sits on the undo / redo stack
+    undo_bytes = 0
+    redo_bytes = 0
+
+    def __init__(self, MDL_index):
+        self.MDL_index = MDL_index
+        self.index_before = 0
+        self.index_after = 0
+
+    def redo(self, MDL):
+        raise NotImplementedError
+
+    def undo(self, MDL):
+        raise NotImplementedError
+
+class SetDurationsCommand(Command):
+    def __init__(self, MDL_index, indices, old_values, new_values):
+        super().__init__(MDL_index)
+        self.indices = list(indices)
+        self.old_values = list(old_values)
+        self.new_values = list(new_values)
+
+    def redo(self, MDL):
+        MDL.set_durations(self.indices, self.new_values)
+
+    def undo(self, MDL):
+        MDL.set_durations(self.indices, self.old_values)
+
+class ReverseCommand(Command):
+    def redo(self, MDL):
+        MDL.reverse_order()
+
+    def undo(self, MDL):
+        MDL.reverse_order()
+
+class PendulumCommand(Command):
+    def __init__(self, MDL_index, length):
+        super().__init__(MDL_index)
+        self.length = length
+
+    def redo(self, MDL):
+        n = self.length
+        entries = [MDL.frames.entry(i) for i in range(n - 1, -1, -1)]
+        durations = MDL.durations[n - 1::-1]
+        MDL.insert_frames(range(n, 2 * n), entries, durations)
+
+    def undo(self, MDL):
+        MDL.remove_frames(range(self.length, 2 * self.length))
+
+class MoveFramesCommand(Command):
+    def __init__(self, MDL_index, positions, insert_pos):
+        super().__init__(MDL_index)
+        self.positions = sorted(positions)
+        self.insert_pos = insert_pos
+
+    def redo(self, MDL):
+        MDL.move_frames(self.positions, self.insert_pos)
+
+    def undo(self, MDL):
+        moved = range(self.insert_pos, self.insert_pos + len(self.positions))
+        entries, durations = MDL.remove_frames(moved)
+        MDL.insert_frames(self.positions, entries, durations)
+
+class InsertFramesCommand(Command):
+    def __init__(self, MDL_index, positions, entries, durations):
+        super().__init__(MDL_index)
+        self.positions = list(positions)
+        self.entries = list(entries)
+        self.durations = list(durations)
+        self.redo_bytes = held_bytes(self.entries)
+
+    def redo(self, MDL):
+        MDL.insert_frames(self.positions, self.entries, self.durations)
+
+    def undo(self, MDL):
+        MDL.remove_frames(self.positions)
+
+class RemoveFramesCommand(Command):
+    def __init__(self, MDL_index, positions):
+        super().__init__(MDL_index)
+        self.positions = sorted(positions)
+        self.entries = []
+        self.durations = []
+
+    def redo(self, MDL):
+        self.entries, self.durations = MDL.remove_frames(self.positions)
+        self.undo_bytes = held_bytes(self.entries)
+
+    def undo(self, MDL):
+        MDL.insert_frames(self.positions, self.entries, self.durations)
+
+class ReplaceFramesCommand(Command):
+    # For edits that produce new pixels (crop, resize, merge, concat). Frames
+    # present on both sides are shared and not counted against the budget.
+    def __init__(self, MDL_index, old_entries, old_durations, new_entries, new_durations):
+        super().__init__(MDL_index)
+        self.old_entries = list(old_entries)
+        self.old_durations = list(old_durations)
+        self.new_entries = list(new_entries)
+        self.new_durations = list(new_durations)
+        self.undo_bytes = held_bytes(self.old_entries, self.new_entries)
+        self.redo_bytes = held_bytes(self.new_entries, self.old_entries)
+
+    def redo(self, MDL):
+        MDL.replace_frames(self.new_entries, self.new_durations)
+
+    def undo(self, MDL):
+        MDL.replace_frames(self.old_entries, self.old_durations)
+
+class UndoHistory:
+    def __init__(self, max_bytes=HISTORY_BYTES, limit=HISTORY_LIMIT):
+        self.max_bytes = max_bytes
+        self.limit = limit
+        self.undo_stack = []
+        self.redo_stack = []
+
+    @property
+    def nbytes(self):
+        return sum(c.undo_bytes for c in self.undo_stack) + sum(c.redo_bytes for c in self.redo_stack)
+
+    def run(self, command, MDL):
+        command.index_before = MDL.current_frame_index
+        command.redo(MDL)
+        command.index_after = MDL.current_frame_index
+        self.push(command)
+
+    def push(self, command):
+        # command has already been applied
+        self.undo_stack.append(command)
+        self.redo_stack.clear()
+        self.trim()
+
+    def undo(self, MDL_of):
+        if not self.undo_stack:
+            return None
+        command = self.undo_stack.pop()
+        MDL = MDL_of(command.MDL_index)
+        command.undo(MDL)
+        MDL.current_frame_index = max(0, min(command.index_before, len(MDL.frames) - 1))
+        self.redo_stack.append(command)
+        self.trim()
+        return MDL
+
+    def redo(self, MDL_of):
+        if not self.redo_stack:
+            return None
+        command = self.redo_stack.pop()
+        MDL = MDL_of(command.MDL_index)
+        command.redo(MDL)
+        MDL.current_frame_index = max(0, min(command.index_after, len(MDL.frames) - 1))
+        self.undo_stack.append(command)
+        self.trim()
+        return MDL
+
+    def discard(self, MDL_index):
+        self.undo_stack = [c for c in self.undo_stack if c.MDL_index != MDL_index]
+        self.redo_stack = [c for c in self.redo_stack if c.MDL_index != MDL_index]
+
+    def trim(self):
+        while len(self.undo_stack) > self.limit:
+            self.undo_stack.pop(0)
+        # oldest history goes first; the next undo step is always kept
+        nbytes = self.nbytes
+        while nbytes > self.max_bytes:
+            if len(self.undo_stack) > 1:
+                nbytes -= self.undo_stack.pop(0).undo_bytes
+            elif self.redo_stack and (self.undo_stack or len(self.redo_stack) > 1):
+                nbytes -= self.redo_stack.pop(0).redo_bytes
+            else:
+                break
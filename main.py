@@ -4,32 +4,51 @@ TODO LIST:
 '''
 
 import sys
+import math
+import time
+import threading
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QLabel, QPushButton, QVBoxLayout, QHBoxLayout,
-    QScrollArea, QMessageBox, QFrame, QSizePolicy, QSpinBox, QDialog
+    QMessageBox, QFrame, QSizePolicy, QSpinBox, QDialog, QListView,
+    QAbstractItemView, QStyledItemDelegate, QComboBox, QProgressDialog, QMenu
 )
-from PyQt6.QtCore import Qt, QTimer, QMimeData, QRect, QSize
-from PyQt6.QtGui import QPixmap, QDrag, QCursor
+from PyQt6.QtCore import (
+    Qt, QTimer, QMimeData, QRect, QSize, QAbstractListModel, QModelIndex, QObject, pyqtSignal
+)
+from PyQt6.QtGui import QPixmap, QDrag, QCursor, QColor, QFont, QFontMetrics, QPen
 from PyQt6.QtWidgets import QRubberBand
-from PIL import Image, ImageSequence
+from PIL import Image
 from PIL.ImageQt import ImageQt
+from frame_store import FrameSequence, StackFrame, frame_cache
+import engine
+from history import (
+    UndoHistory, SetDurationsCommand, ReverseCommand, PendulumCommand, MoveFramesCommand,
+    InsertFramesCommand, RemoveFramesCommand, ReplaceFramesCommand, held_bytes
+)
+from tracing import tracer
 import os
 
 MODE_MERGE = 0
 MODE_CONCAT = 1
 
-# HELPER FUNCTIONS
-def custom_round(op):
-    from math import modf, isclose
-    
-    fractional_part, integer_part = modf(op)
-    
-    if fractional_part > 0.5 or isclose(fractional_part, 0.5000, abs_tol=1e-4):
-        integer_part += 1
-        fractional_part = 0.0
+THUMB_HEIGHT = 60
+THUMB_MARGIN = 4
+THUMB_TEXT_HEIGHT = 14
+THUMB_BUTTON_SIZE = 16
 
-    return integer_part, fractional_part
+SCALED_CACHE_BYTES = 256 * 1024 * 1024
+PREVIEW_PYRAMID_BYTES = 256 * 1024 * 1024
+# background jobs quicker than this finish without showing a progress dialog
+JOB_DIALOG_DELAY_MS = 400
+# while tracing, memory is sampled and the overlay refreshed this often
+TRACE_REFRESH_MS = 1000
+TRACE_OVERLAY_SPANS = 12
+TRACE_OVERLAY_STEPS = 5
 
+# HELPER FUNCTIONS
 def deleteItemsOfLayout(layout):
     if layout is not None:
         while layout.count():
@@ -40,6 +59,9 @@ def deleteItemsOfLayout(layout):
             else:
                 deleteItemsOfLayout(item.layout())
 
+def megabytes(nbytes):
+    return f"{nbytes / 1024 / 1024:.1f} MB"
+
 class ResizePopup(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -61,10 +83,203 @@ class ResizePopup(QDialog):
 
         layout.addLayout(w_area)
 
+        f_area = QHBoxLayout()
+        f_area.addWidget(QLabel("Filter"))
+
+        # slower filters first; Nearest is the fastest but the roughest
+        self.filter_combo_box = QComboBox()
+        self.filter_combo_box.addItem("Lanczos (best)", "lanczos")
+        self.filter_combo_box.addItem("Bicubic", "bicubic")
+        self.filter_combo_box.addItem("Bilinear", "bilinear")
+        self.filter_combo_box.addItem("Nearest (fastest)", "nearest")
+        f_area.addWidget(self.filter_combo_box)
+
+        layout.addLayout(f_area)
+
         ok_button = QPushButton("OK")
         ok_button.clicked.connect(self.accept)  # Closes the dialog and sets result to Accepted
         layout.addWidget(ok_button)
 
+class ScaledPixmapCache:
+    # Display-ready pixmaps already scaled to the preview label. All of them
+    # share one target size, so a resize simply starts over.
+    def __init__(self, max_bytes=SCALED_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.size = None
+        self.items = OrderedDict()
+
+    def get(self, entry, size):
+        if size != self.size:
+            self.clear()
+            self.size = size
+            return None
+        pixmap = self.items.get(entry)
+        if pixmap is not None:
+            self.items.move_to_end(entry)
+        return pixmap
+
+    def put(self, entry, pixmap):
+        if entry in self.items:
+            old = self.items.pop(entry)
+            self.nbytes -= old.width() * old.height() * 4
+        self.items[entry] = pixmap
+        self.nbytes += pixmap.width() * pixmap.height() * 4
+        while self.nbytes > self.max_bytes and len(self.items) > 1:
+            _, evicted = self.items.popitem(last=False)
+            self.nbytes -= evicted.width() * evicted.height() * 4
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+class PreviewPyramid:
+    # Frames reduced to 1/2, 1/4, 1/8, ... of their size, each level made when
+    # first needed from the nearest finer level already there. The preview is
+    # scaled from the smallest level still as large as the label, so redrawing
+    # it costs about the same for any source size.
+    def __init__(self, max_bytes=PREVIEW_PYRAMID_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items = OrderedDict()
+
+    def get(self, entry, size):
+        # the frame at the coarsest level that still covers size when fitted into it
+        w, h = entry.size
+        scale = min(size[0] / w, size[1] / h)
+        level = 0
+        while scale * 2 ** (level + 1) <= 1 and min(w, h) >> (level + 1):
+            level += 1
+        return self.level(entry, level)
+
+    def level(self, entry, level):
+        if level == 0:
+            return entry.load()
+        image = self.items.get((entry, level))
+        if image is not None:
+            self.items.move_to_end((entry, level))
+            return image
+        finer = level - 1
+        while finer > 0 and (entry, finer) not in self.items:
+            finer -= 1
+        image = self.level(entry, finer)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        with tracer.span("reduce", level=level):
+            image = image.reduce(2 ** (level - finer))
+        self.put((entry, level), image)
+        return image
+
+    def put(self, key, image):
+        self.items[key] = image
+        self.nbytes += image.width * image.height * 4
+        while self.nbytes > self.max_bytes and len(self.items) > 1:
+            _, evicted = self.items.popitem(last=False)
+            self.nbytes -= evicted.width * evicted.height * 4
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+class PlaybackEngine(QObject):
+    # Plays a MainDropLabel using each frame's own duration. Frame deadlines are
+    # absolute on a monotonic clock, so timer jitter never accumulates, and
+    # frames whose slot has already passed are skipped instead of delayed.
+    def __init__(self, label):
+        super().__init__(label)
+        self.label = label
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+        self.deadline = 0.0
+        self.loop_duration = 0
+        self.skipped_frames = 0
+
+    def frame_duration(self, index):
+        return max(1, self.label.durations[index]) / 1000
+
+    def start(self):
+        if not self.label.frames:
+            return
+        self.loop_duration = sum(self.label.durations)
+        self.skipped_frames = 0
+        index = self.label.current_frame_index % len(self.label.frames)
+        self.deadline = time.monotonic() + self.frame_duration(index)
+        self.schedule()
+
+    def stop(self):
+        self.timer.stop()
+
+    def schedule(self):
+        delay = self.deadline - time.monotonic()
+        self.timer.start(max(0, math.ceil(delay * 1000)))
+
+    def tick(self):
+        frames = self.label.frames
+        if not frames:
+            return
+        now = time.monotonic()
+        if now < self.deadline:
+            self.schedule()
+            return
+        # after a stall longer than the whole loop, restart the clock instead of racing through it
+        if now - self.deadline > self.loop_duration / 1000:
+            self.deadline = now
+
+        index = self.label.current_frame_index % len(frames)
+        while True:
+            index = (index + 1) % len(frames)
+            if index == 0:
+                self.loop_duration = sum(self.label.durations)
+            self.deadline += self.frame_duration(index)
+            if self.deadline > now:
+                break
+            self.skipped_frames += 1
+
+        self.label.current_frame_index = index
+        self.label.display_frame(index, self.loop_duration)
+        self.schedule()
+
+class BackgroundJob(QObject):
+    # Runs work(job) on a worker thread so the window stays responsive.
+    # job.progress(done, total) is forwarded to the GUI thread and raises
+    # engine.Cancelled once the job is cancelled, job.publish(item) hands a
+    # partial result over; the result or the error comes back to the GUI
+    # thread through the signals as well, after everything published.
+    progressed = pyqtSignal(int, int)
+    published = pyqtSignal(object)
+    succeeded = pyqtSignal(object)
+    failed = pyqtSignal(object)
+
+    def __init__(self, work):
+        super().__init__()
+        self.work = work
+        self.cancelled = threading.Event()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def progress(self, done, total):
+        if self.cancelled.is_set():
+            raise engine.Cancelled()
+        self.progressed.emit(done, total)
+
+    def publish(self, item):
+        self.published.emit(item)
+
+    def run(self):
+        try:
+            result = self.work(self)
+        except BaseException as e:
+            self.failed.emit(e)
+            return
+        self.succeeded.emit(result)
+
 class MainDropLabel(QLabel):
     def __init__(self, parent, MDL_index):
         super().__init__()
@@ -75,28 +290,32 @@ class MainDropLabel(QLabel):
         self.setStyleSheet("border: 2px dashed #666; font-size: 18px;")
         
         self.MDL_index = MDL_index
-        self.frames = []
+        self.frames = FrameSequence()
         self.current_frame_index = 0
         self.is_playing = False
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.play_next_frame)
+        self.playback = PlaybackEngine(self)
+        self.scaled_pixmaps = ScaledPixmapCache()
+        self.preview_pyramid = PreviewPyramid()
         self.selected_indices = set()
 
     def reset(self):
         self.setText("Drag and drop the animated image you want to edit here")
         self.setStyleSheet("border: 2px dashed #666; font-size: 18px;")
-        for f in self.frames:
-            f.close()
         if hasattr(self, 'frames'):
             self.frames.clear()
         if hasattr(self, 'durations'):
             self.durations.clear()
         self.durations = []
         self.current_frame_index = 0
+        self.playback.stop()
         self.is_playing = False
+        self.scaled_pixmaps.clear()
+        self.preview_pyramid.clear()
         self.selected_indices.clear()
 
     def load_animation(self, file_path):
+        if self.parent.parent.parent.parent.refuse_if_busy():
+            return
         if self.frames:
             box = QMessageBox(self)
             box.setWindowTitle("Replace or Merge?")
@@ -128,30 +347,49 @@ class MainDropLabel(QLabel):
                     QMessageBox.critical(self, "Error", f"Failed to load second image: {str(e)}")
                     return
                 
-        self.ext = os.path.splitext(file_path)[-1].lower()
-        if self.ext not in [".gif", ".webp", ".jpg", ".jpeg", ".png"]:
+        ext = os.path.splitext(file_path)[-1].lower()
+        if ext not in engine.SUPPORTED_EXTENSIONS:
             QMessageBox.critical(self, "Unsupported File", "Only image files are supported.")
             return
 
+        # The first frame is shown as soon as it is decoded and the rest is
+        # appended in batches, which can be played while the rest is loading.
+        shown = False
+        removed = 0
+        def load(job):
+            # frames are decoded lazily when displayed, edited or exported
+            for batch in engine.load_batches(file_path, engine.COALESCE_ON_LOAD, job.progress):
+                job.publish(batch)
+
+        def arrived(batch):
+            nonlocal shown, removed
+            entries, durations, batch_removed = batch
+            removed += batch_removed
+            if shown:
+                self.append_frames(entries, durations)
+            else:
+                shown = True
+                self.ext = ext
+                self.show_animation(FrameSequence.from_entries(entries), durations)
+
+        def loaded(result):
+            if removed:
+                QMessageBox.information(self, "Duplicate Frames", f"Merged {removed} duplicate frames into their neighbours.")
+
+        self.parent.parent.parent.parent.start_job(
+            f"Loading {os.path.basename(file_path)}...", load, loaded, "Failed to load image", arrived)
+
+    def show_animation(self, frames, durations):
         try:
             self.reset()
+            # earlier steps refer to the frames being replaced
+            self.parent.parent.parent.parent.history.discard(self.MDL_index)
             self.setStyleSheet("")
-            img = Image.open(file_path)
-            for frame in ImageSequence.Iterator(img):
-                self.frames.append(frame.convert("RGBA"))
-                self.durations.append(frame.info.get("duration", 100))
+            self.frames, self.durations = frames, durations
             self.current_frame_index = 0
             self.display_frame(self.current_frame_index)
             self.populate_frame_area()
 
-            # INSERTION LINE
-            if not hasattr(self, 'insertion_line'):
-                self.insertion_line = QFrame(self.parent.parent.parent.itemAt(2).itemAt(self.MDL_index).widget().widget())
-                self.insertion_line.setFrameShape(QFrame.Shape.VLine)
-                self.insertion_line.setStyleSheet("color: blue; background-color: blue;")
-                self.insertion_line.setFixedWidth(2)
-                self.insertion_line.hide()
-
             if not hasattr(self, 'buttons'):
                 self.buttons = QHBoxLayout()
 
@@ -179,82 +417,78 @@ class MainDropLabel(QLabel):
                 self.buttons.addWidget(self.resize_button, alignment=Qt.AlignmentFlag.AlignCenter)
 
                 self.parent.addLayout(self.buttons)
+            self.set_editable(not self.parent.parent.parent.parent.busy())
 
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Failed to load image: {str(e)}")
 
+    def set_editable(self, editable):
+        # the edit buttons are off while a background job runs
+        for button in (self.update_button, self.reverse_button, self.pendulum_button, self.resize_button):
+            button.setEnabled(editable)
+
+    def append_frames(self, entries, durations):
+        # more frames of the animation being loaded
+        model = self.timeline().model()
+        model.beginInsertRows(QModelIndex(), len(self.frames), len(self.frames) + len(entries) - 1)
+        self.frames.extend(entries)
+        self.durations.extend(durations)
+        model.endInsertRows()
+        self.display_frame(self.current_frame_index)
+
     def handle_resizing(self):
+        if self.parent.parent.parent.parent.refuse_if_busy():
+            return
         dialog = ResizePopup(self)
         if dialog.exec() == QDialog.DialogCode.Accepted:
             height = dialog.integer_spin_box.value()
-            self.resize_frames(height)
+            resample = engine.RESAMPLE_FILTERS[dialog.filter_combo_box.currentData()]
+            self.resize_frames(height, resample)
+
+    def resize_frames(self, height, resample=Image.LANCZOS):
+        frames = self.frames
+        def resize(job):
+            return FrameSequence(engine.resize_frames(frames, height, resample, progress=job.progress)).entries()
+        def resized(entries):
+            self.parent.parent.parent.parent.run_command(
+                ReplaceFramesCommand(self.MDL_index, frames.entries(), self.durations, entries, self.durations))
             self.display_frame(self.current_frame_index)
-
-    def resize_frames(self, height):
-        w, h = self.frames[0].size
-        aspect_ratio = h / w
-        new_h = height
-        new_w = int(new_h / aspect_ratio)
-
-        for idx, f in enumerate(self.frames):
-            resized = f.resize((new_w, new_h), Image.LANCZOS)
-            f.close()
-            self.frames[idx] = resized
+        self.parent.parent.parent.parent.start_job("Resizing...", resize, resized, "Failed to resize")
 
     def update_frame_durations(self):
         if not self.selected_indices:
             return
 
-        self.parent.parent.parent.parent.save_state(self.MDL_index)
         val = self.integer_spin_box.value()
-        duration_sum = 0
-        for idx in self.selected_indices:
-            if val > 0:
-                self.durations[idx] += val
-            else:
-                self.durations[idx] = max(1, self.durations[idx] + val)
-            duration_sum += self.durations[idx]
+        indices = sorted(self.selected_indices)
+        old_values = [self.durations[idx] for idx in indices]
+        if val > 0:
+            new_values = [d + val for d in old_values]
+        else:
+            new_values = [max(1, d + val) for d in old_values]
+        if not self.parent.parent.parent.parent.run_command(SetDurationsCommand(self.MDL_index, indices, old_values, new_values)):
+            return
+        duration_sum = sum(new_values)
 
         frame_info_label = self.parent.itemAt(1).widget()
-        idx = sorted(self.selected_indices)[0]
-        w, h = self.frames[idx].size
+        idx = indices[0]
+        w, h = self.frames.entry(idx).size
         frame_info_label.setText(f"Displaying frame {idx + 1} of {len(self.frames)} ({sum(self.durations)} ms in total)\n{w} x {h}" \
                                  + f"\nduration of selected frames: {str(duration_sum)} ms")
-        self.populate_frame_area()
 
-    def populate_frame_area(self):
-        self.highlighted_thumbs = []
-        frame_layout = self.parent.parent.parent.itemAt(2).itemAt(self.MDL_index).widget().widget().layout()
+    def timeline(self):
+        return self.parent.parent.parent.itemAt(2).itemAt(self.MDL_index).widget()
 
-        for i in reversed(range(frame_layout.count())):
-            item = frame_layout.itemAt(i)
-            widget = item.widget()
-            if widget:
-                widget.deleteLater()
-                
-        # update frame indices so thumbnail labels reflect new order
-        for idx, frame in enumerate(self.frames):
-            pixmap = QPixmap.fromImage(ImageQt(frame))
-            thumb = FrameThumbnail(self, idx, pixmap)
-            thumb.parent = self.parent.parent.parent.itemAt(2).itemAt(self.MDL_index).widget()
-            frame_layout.addWidget(thumb)
-            self.highlighted_thumbs.append(thumb)
-            if idx in self.selected_indices:
-                thumb.setStyleSheet("border: 2px solid blue;")
-            else:
-                thumb.setStyleSheet("")
+    def populate_frame_area(self):
+        # the timeline only paints the thumbnails in view, so a full reset is cheap
+        with tracer.span("populate_frame_area", frames=len(self.frames)):
+            self.timeline().model().reset_frames()
     
     def reverse_frames(self):
         if not self.frames:
             QMessageBox.warning(self, "Warning", "No frames to reverse.")
             return
-        self.parent.parent.parent.parent.save_state(self.MDL_index)
-        self.frames.reverse()
-        if hasattr(self, 'durations'):
-            self.durations.reverse()
-        self.selected_indices = {len(self.frames) - 1 - i for i in self.selected_indices}
-        self.current_frame_index = len(self.frames) - 1 - self.current_frame_index
-        self.populate_frame_area()
+        self.parent.parent.parent.parent.run_command(ReverseCommand(self.MDL_index))
         self.display_frame(self.current_frame_index)
 
     def pendulum_frames(self):
@@ -262,11 +496,7 @@ class MainDropLabel(QLabel):
             QMessageBox.warning(self, "Warning", "No frames to reverse.")
             return
         
-        self.parent.parent.parent.parent.save_state(self.MDL_index)
-        self.frames.extend(self.frames[::-1])
-        if hasattr(self, 'durations'):
-            self.durations.extend(self.durations[::-1])
-        self.populate_frame_area()
+        self.parent.parent.parent.parent.run_command(PendulumCommand(self.MDL_index, len(self.frames)))
         self.display_frame(self.current_frame_index)
 
 
@@ -291,64 +521,54 @@ class MainDropLabel(QLabel):
         self.highlight_selected_frames()
 
     def highlight_selected_frames(self):
-        frame_layout = self.parent.parent.parent.itemAt(2).itemAt(self.MDL_index).widget().widget().layout()
-
-        duration_sum = 0
-        for i in range(frame_layout.count()):
-            thumb = frame_layout.itemAt(i).widget()
-            if i in self.selected_indices:
-                duration_sum += self.durations[i]
-                thumb.setStyleSheet("border: 2px solid blue;")
-            else:
-                thumb.setStyleSheet("")
+        duration_sum = sum(self.durations[i] for i in self.selected_indices if i < len(self.durations))
+        self.timeline().viewport().update()
 
         
         idx = sorted(self.selected_indices)[0] if self.selected_indices else 0
-        w, h = self.frames[idx].size
+        w, h = self.frames.entry(idx).size
         frame_info_label = self.parent.itemAt(1).widget()
         frame_info_label.setText(f"Displaying frame {idx + 1} of {len(self.frames)} ({sum(self.durations)} ms in total)\n{w} x {h}"\
                                   + f"\nduration of selected frames: {str(duration_sum)} ms")
     
     def reorder_frames(self, source_index, target_index):
-        self.parent.parent.parent.parent.save_state(self.MDL_index)
-
         if not self.selected_indices:
             self.selected_indices = {source_index}
 
         selected = sorted(self.selected_indices)
-        moving = [self.frames[i] for i in selected]
-        moving_durations = [self.durations[i] for i in selected]
-
-        for i in reversed(selected):
-            del self.frames[i]
-            del self.durations[i]
-
-        insert_pos = target_index
-        for i, (f, d) in enumerate(zip(moving, moving_durations)):
-            self.frames.insert(insert_pos + i, f)
-            self.durations.insert(insert_pos + i, d)
-
-        self.selected_indices = set(range(insert_pos, insert_pos + len(moving)))
-        self.populate_frame_area()
-        self.display_frame(self.current_frame_index)
-
-    def play_next_frame(self):
-        self.current_frame_index = (self.current_frame_index + 1) % len(self.frames)
+        insert_pos = min(target_index, len(self.frames) - len(selected))
+        self.parent.parent.parent.parent.run_command(MoveFramesCommand(self.MDL_index, selected, insert_pos))
+        self.highlight_selected_frames()
         self.display_frame(self.current_frame_index)
 
-    def display_frame(self, index):
-        if not self.frames:
-            self.reset()
-            return
+    def display_frame(self, index, total_duration=None):
+        with tracer.span("display_frame", frame=index):
+            if not self.frames:
+                self.reset()
+                return
 
-        if 0 <= index < len(self.frames):
-            self.imageqt_ref = ImageQt(self.frames[index])  # prevent GC
-            pixmap = QPixmap.fromImage(self.imageqt_ref)
-            scaled_pixmap = pixmap.scaled(self.width(), self.height(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-            self.setPixmap(scaled_pixmap)
-            w, h = self.frames[index].size
-            frame_info_label = self.parent.itemAt(1).widget()
-            frame_info_label.setText(f"Displaying frame {index + 1} of {len(self.frames)} ({sum(self.durations)} ms in total)\n{w} x {h}")
+            if 0 <= index < len(self.frames):
+                entry = self.frames.entry(index)
+                scaled_pixmap = self.scaled_pixmaps.get(entry, (self.width(), self.height()))
+                if scaled_pixmap is None:
+                    image = self.preview_pyramid.get(entry, (self.width(), self.height()))
+                    self.imageqt_ref = ImageQt(image)  # prevent GC
+                    pixmap = QPixmap.fromImage(self.imageqt_ref)
+                    scaled_pixmap = pixmap.scaled(self.width(), self.height(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+                    self.scaled_pixmaps.put(entry, scaled_pixmap)
+                self.setPixmap(scaled_pixmap)
+                w, h = entry.size
+                if total_duration is None:
+                    total_duration = sum(self.durations)
+                frame_info_label = self.parent.itemAt(1).widget()
+                frame_info_label.setText(f"Displaying frame {index + 1} of {len(self.frames)} ({total_duration} ms in total)\n{w} x {h}")
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        # cached pixmaps were scaled for the old size
+        self.scaled_pixmaps.clear()
+        if self.frames:
+            self.display_frame(self.current_frame_index)
 
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls():
@@ -363,7 +583,7 @@ class MainDropLabel(QLabel):
 
     # CROPPING FUNCTIONS
     def mousePressEvent(self, event):
-        if not self.frames:
+        if not self.frames or self.parent.parent.parent.parent.refuse_if_busy():
             return
         if event.button() == Qt.MouseButton.LeftButton:
             self.origin = event.pos()
@@ -416,215 +636,519 @@ class MainDropLabel(QLabel):
 
             if reply == QMessageBox.StandardButton.Yes:
                 crop_box = (left, top, right, bottom)
-                self.parent.parent.parent.parent.save_state(self.MDL_index)
-                self.frames = [f.crop(crop_box) for f in self.frames]
-                self.display_frame(self.current_frame_index)
-                self.populate_frame_area()
+                frames = self.frames
+                def crop(job):
+                    return FrameSequence(engine.crop_frames(frames, crop_box, job.progress)).entries()
+                def cropped(entries):
+                    self.parent.parent.parent.parent.run_command(
+                        ReplaceFramesCommand(self.MDL_index, frames.entries(), self.durations, entries, self.durations))
+                    self.display_frame(self.current_frame_index)
+                self.parent.parent.parent.parent.start_job("Cropping...", crop, cropped, "Failed to crop")
 
     # FRAME MODIFICATION FUNCTIONS
     def duplicate_frame(self, index):
-        self.parent.parent.parent.parent.save_state(self.MDL_index)
-
         if 0 <= index < len(self.frames):
-            duplicated = self.frames[index].copy()
-            self.frames.insert(index + 1, duplicated)
-            if hasattr(self, 'durations'):
-                self.durations.insert(index + 1, self.durations[index])
-            self.populate_frame_area()
+            # frames are never modified in place, so the duplicate can share the entry
+            self.parent.parent.parent.parent.run_command(
+                InsertFramesCommand(self.MDL_index, [index + 1], [self.frames.entry(index)], [self.durations[index]]))
 
     def delete_frame(self, index):
-        self.parent.parent.parent.parent.save_state(self.MDL_index)
-
-        if index in self.selected_indices:
-            self.selected_indices.remove(index)
         if 0 <= index < len(self.frames) and len(self.frames) > 1:
-            del self.frames[index]
-            if self.current_frame_index >= len(self.frames):
-                self.current_frame_index = len(self.frames) - 1
-            self.populate_frame_area()
+            self.parent.parent.parent.parent.run_command(RemoveFramesCommand(self.MDL_index, [index]))
             self.display_frame(self.current_frame_index)
 
     def deleteSelectedFrames(self):
-        self.parent.parent.parent.parent.save_state(self.MDL_index)
         if hasattr(self, 'selected_indices') and self.selected_indices:
-            to_delete = sorted(self.selected_indices, reverse=True)
-            for index in to_delete:
-                if 0 <= index < len(self.frames):
-                    del self.frames[index]
-                    if hasattr(self, 'durations'):
-                        del self.durations[index]
+            to_delete = [i for i in self.selected_indices if 0 <= i < len(self.frames)]
+            self.parent.parent.parent.parent.run_command(RemoveFramesCommand(self.MDL_index, to_delete))
             self.selected_indices.clear()
-            self.current_frame_index = min(self.current_frame_index, len(self.frames) - 1)
-            self.populate_frame_area()
             self.display_frame(self.current_frame_index)
-    
-    # UNDO / REDO RELATED FUNCTIONS
-    def get_current_state(self):
-        return (self.MDL_index, self.frames.copy(), self.durations.copy(), self.current_frame_index)
+
+    # FRAME MODIFICATION PRIMITIVES (applied and reverted by the undo history)
+    def insert_frames(self, positions, entries, durations):
+        # positions are the final indices, in ascending order
+        positions = list(positions)
+        model = self.timeline().model()
+        start = 0
+        while start < len(positions):
+            end = start + 1
+            while end < len(positions) and positions[end] == positions[end - 1] + 1:
+                end += 1
+            first, count = positions[start], end - start
+            model.beginInsertRows(QModelIndex(), first, first + count - 1)
+            self.frames[first:first] = entries[start:end]
+            self.durations[first:first] = durations[start:end]
+            model.endInsertRows()
+            self.selected_indices = {i + count if i >= first else i for i in self.selected_indices}
+            start = end
+
+    def remove_frames(self, positions):
+        positions = sorted(positions)
+        entries = [self.frames.entry(i) for i in positions]
+        durations = [self.durations[i] for i in positions]
+        model = self.timeline().model()
+        # remove runs of consecutive frames back to front, one notification per run
+        to_delete = list(positions)
+        while to_delete:
+            last = first = to_delete.pop()
+            while to_delete and to_delete[-1] == first - 1:
+                first = to_delete.pop()
+            model.beginRemoveRows(QModelIndex(), first, last)
+            del self.frames[first:last + 1]
+            del self.durations[first:last + 1]
+            model.endRemoveRows()
+        removed = set(positions)
+        self.selected_indices = {i - bisect_left(positions, i) for i in self.selected_indices if i not in removed}
+        self.current_frame_index = max(0, min(self.current_frame_index, len(self.frames) - 1))
+        return entries, durations
+
+    def move_frames(self, selected, insert_pos):
+        # a contiguous block can be announced to the timeline as a single move
+        model = self.timeline().model()
+        count = len(selected)
+        contiguous = selected[-1] - selected[0] == count - 1
+        move_to = insert_pos if insert_pos <= selected[0] else insert_pos + count
+        if contiguous and insert_pos == selected[0]:
+            moved = False
+        elif contiguous:
+            moved = model.beginMoveRows(QModelIndex(), selected[0], selected[-1], QModelIndex(), move_to)
+        else:
+            model.beginResetModel()
+            moved = True
+
+        self.frames.move(selected, insert_pos)
+        moving = set(selected)
+        rest = [d for i, d in enumerate(self.durations) if i not in moving]
+        self.durations = rest[:insert_pos] + [self.durations[i] for i in selected] + rest[insert_pos:]
+
+        if moved and contiguous:
+            model.endMoveRows()
+        elif moved:
+            model.endResetModel()
+
+        self.selected_indices = set(range(insert_pos, insert_pos + count))
+
+    def set_durations(self, indices, values):
+        for idx, value in zip(indices, values):
+            self.durations[idx] = value
+        self.timeline().model().frames_changed(indices)
+
+    def reverse_order(self):
+        self.frames.reverse()
+        self.durations.reverse()
+        self.selected_indices = {len(self.frames) - 1 - i for i in self.selected_indices}
+        self.current_frame_index = len(self.frames) - 1 - self.current_frame_index
+        self.populate_frame_area()
+
+    def replace_frames(self, entries, durations):
+        self.overwrite_state(entries, list(durations), self.current_frame_index)
+        self.selected_indices = {i for i in self.selected_indices if i < len(self.frames)}
+        self.current_frame_index = max(0, min(self.current_frame_index, len(self.frames) - 1))
+        self.populate_frame_area()
 
     def overwrite_state(self, frames, durations, current_frame_index):
-        self.frames.clear()
-        self.durations.clear()
-        self.frames = frames
+        self.frames = FrameSequence(frames)
         self.durations = durations
         self.current_frame_index = current_frame_index
 
-class FrameThumbnail(QFrame):
+class ThumbnailCache(QObject):
+    # Thumbnails keyed by frame entry identity. Entries are never modified in
+    # place, so a thumbnail stays valid through reorders, reverse, pendulum and
+    # undo/redo; only frames with new pixels (crop, resize, ...) get a new entry.
+    thumbnail_ready = pyqtSignal(object, object)
+    updated = pyqtSignal()
+
+    def __init__(self, height=THUMB_HEIGHT, max_pending=256):
+        super().__init__()
+        self.height = height
+        self.max_pending = max_pending
+        self.pixmaps = weakref.WeakKeyDictionary()
+        self.pending = []
+        self.queued = set()
+        self.condition = threading.Condition()
+        self.thumbnail_ready.connect(self.store)
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def get(self, entry):
+        pixmap = self.pixmaps.get(entry)
+        if pixmap is None:
+            self.request(entry)
+        return pixmap
+
+    def request(self, entry):
+        with self.condition:
+            if entry in self.queued:
+                return
+            self.queued.add(entry)
+            self.pending.append(entry)
+            # drop the oldest requests, they have most likely scrolled out of view
+            if len(self.pending) > self.max_pending:
+                self.queued.discard(self.pending.pop(0))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # newest first, so whatever is on screen right now wins
+                entry = self.pending.pop()
+            try:
+                with tracer.span("thumbnail"):
+                    frame = entry.load()
+                    w, h = frame.size
+                    thumb = frame.resize((max(1, round(self.height * w / h)), self.height), Image.BILINEAR, reducing_gap=2.0)
+                    image = ImageQt(thumb).copy()
+            except Exception:
+                image = None
+            self.thumbnail_ready.emit(entry, image)
+
+    def store(self, entry, image):
+        with self.condition:
+            self.queued.discard(entry)
+        if image is not None:
+            self.pixmaps[entry] = QPixmap.fromImage(image)
+        self.updated.emit()
+
+class FrameListModel(QAbstractListModel):
+    def __init__(self, editor, thumbnails):
+        super().__init__()
+        self.editor = editor
+        self.thumbnails = thumbnails
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.editor.frames)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        row = index.row()
+        if not index.isValid() or row >= len(self.editor.frames):
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"#{row+1} ({self.editor.durations[row]}ms)"
+        if role == Qt.ItemDataRole.DecorationRole:
+            return self.thumbnail(row)
+        return None
+
+    def thumbnail(self, row):
+        # None until the background worker has rendered it
+        return self.thumbnails.get(self.editor.frames.entry(row))
+
+    def reset_frames(self):
+        self.beginResetModel()
+        self.endResetModel()
+
+    def frames_changed(self, rows):
+        for row in rows:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+class FrameThumbnailDelegate(QStyledItemDelegate):
+    def __init__(self, timeline):
+        super().__init__(timeline)
+        self.timeline = timeline
+        self.font = QFont()
+        self.font.setPixelSize(10)
+
+    def sizeHint(self, option, index):
+        return self.timeline.item_size()
+
+    def paint(self, painter, option, index):
+        row = index.row()
+        rect = option.rect
+        thumb_rect = self.timeline.thumb_rect(row, rect)
+        painter.save()
+
+        pixmap = index.data(Qt.ItemDataRole.DecorationRole)
+        if pixmap is not None:
+            painter.drawPixmap(thumb_rect.topLeft(), pixmap)
+        else:
+            painter.fillRect(thumb_rect, QColor("#ddd"))
+
+        painter.setFont(self.font)
+        painter.setPen(QColor("gray"))
+        text_rect = QRect(rect.left(), thumb_rect.bottom() + 2, rect.width(), THUMB_TEXT_HEIGHT)
+        painter.drawText(text_rect, Qt.AlignmentFlag.AlignCenter, index.data(Qt.ItemDataRole.DisplayRole))
+
+        if row in self.timeline.editor.selected_indices:
+            painter.setPen(QPen(QColor("blue"), 2))
+            painter.drawRect(rect.adjusted(1, 1, -1, -1))
+
+        if row == self.timeline.hover_row:
+            duplicate_rect, delete_rect = self.timeline.button_rects(row, rect)
+            bold = QFont(self.font)
+            bold.setBold(True)
+            painter.setFont(bold)
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.fillRect(duplicate_rect, QColor("lightblue"))
+            painter.fillRect(delete_rect, QColor("lightcoral"))
+            painter.setPen(QColor("black"))
+            painter.drawText(duplicate_rect, Qt.AlignmentFlag.AlignCenter, "D")
+            painter.drawText(delete_rect, Qt.AlignmentFlag.AlignCenter, "X")
+
+        painter.restore()
+
+class FrameTimeline(QListView):
+    # Virtualized strip of frame thumbnails: only the items inside the visible
+    # scroll range are ever painted, and edits notify the model row by row.
+    def __init__(self, editor, thumbnails):
+        super().__init__()
+        self.editor = editor
+        self.setObjectName("frame_area")
+        self.setModel(FrameListModel(editor, thumbnails))
+        self.setItemDelegate(FrameThumbnailDelegate(self))
+        self.setFlow(QListView.Flow.LeftToRight)
+        self.setWrapping(False)
+        self.setUniformItemSizes(True)
+        self.setSpacing(3)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.setHorizontalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAsNeeded)
+        self.setFixedHeight(120)
+        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
+        self.setMouseTracking(True)
+        self.setAcceptDrops(True)
+        self.viewport().setAcceptDrops(True)
+
+        self.hover_row = -1
+        self.press_row = -1
+        self.drag_start_pos = None
+
+        # INSERTION LINE
+        self.insertion_line = QFrame(self.viewport())
+        self.insertion_line.setFrameShape(QFrame.Shape.VLine)
+        self.insertion_line.setStyleSheet("color: blue; background-color: blue;")
+        self.insertion_line.setFixedWidth(2)
+        self.insertion_line.hide()
+
+        self.drag_scroll_timer = QTimer(self)
+        self.drag_scroll_timer.setInterval(50)
+        self.drag_scroll_timer.timeout.connect(self.scroll_while_dragging)
+
+        self.text_metrics = QFontMetrics(self.itemDelegate().font)
+        thumbnails.updated.connect(self.viewport().update)
+
+    # GEOMETRY
+    def thumb_width(self, row):
+        w, h = self.editor.frames.entry(row).size
+        return max(1, round(THUMB_HEIGHT * w / h))
+
+    def item_size(self):
+        if not self.editor.frames:
+            return QSize(0, 0)
+        text_width = self.text_metrics.horizontalAdvance(f"#{len(self.editor.frames)} (99999ms)")
+        width = max(self.thumb_width(0), text_width) + 2 * THUMB_MARGIN
+        return QSize(width, THUMB_HEIGHT + THUMB_TEXT_HEIGHT + 3 * THUMB_MARGIN)
+
+    def thumb_rect(self, row, item_rect):
+        width = self.thumb_width(row)
+        left = item_rect.left() + (item_rect.width() - width) // 2
+        return QRect(left, item_rect.top() + THUMB_MARGIN, width, THUMB_HEIGHT)
+
+    def button_rects(self, row, item_rect):
+        thumb_rect = self.thumb_rect(row, item_rect)
+        top = thumb_rect.center().y() - THUMB_BUTTON_SIZE // 2
+        duplicate_rect = QRect(thumb_rect.left(), top, THUMB_BUTTON_SIZE, THUMB_BUTTON_SIZE)
+        delete_rect = QRect(thumb_rect.right() - THUMB_BUTTON_SIZE + 1, top, THUMB_BUTTON_SIZE, THUMB_BUTTON_SIZE)
+        return duplicate_rect, delete_rect
+
+    def set_hover_row(self, row):
+        if row != self.hover_row:
+            self.hover_row = row
+            self.viewport().update()
+
+    # DRAG SCROLLING
     def start_scroll_timer(self):
-        if not hasattr(self, 'drag_scroll_timer'):
-            self.drag_scroll_timer = QTimer(self)
-            self.drag_scroll_timer.setInterval(50)
-            self.drag_scroll_timer.timeout.connect(self.scroll_while_dragging)
         self.drag_scroll_timer.start()
 
     def stop_scroll_timer(self):
-        if hasattr(self, 'drag_scroll_timer'):
-            self.drag_scroll_timer.stop()
+        self.drag_scroll_timer.stop()
 
     def scroll_while_dragging(self):
-        scroll_area = self.parent
         cursor_global = QCursor.pos()
-        cursor_pos = scroll_area.viewport().mapFromGlobal(cursor_global)
+        cursor_pos = self.viewport().mapFromGlobal(cursor_global)
         margin = 40
         scroll_speed = 30
         if cursor_pos.x() < margin:
-            scroll_area.horizontalScrollBar().setValue(scroll_area.horizontalScrollBar().value() - scroll_speed)
-        elif cursor_pos.x() > scroll_area.viewport().width() - margin:
-            scroll_area.horizontalScrollBar().setValue(scroll_area.horizontalScrollBar().value() + scroll_speed)
-
-    def enterEvent(self, event):
-        self.duplicate_btn.show()
-        self.delete_btn.show()
+            self.horizontalScrollBar().setValue(self.horizontalScrollBar().value() - scroll_speed)
+        elif cursor_pos.x() > self.viewport().width() - margin:
+            self.horizontalScrollBar().setValue(self.horizontalScrollBar().value() + scroll_speed)
 
+    # MOUSE EVENTS
     def leaveEvent(self, event):
-        self.duplicate_btn.hide()
-        self.delete_btn.hide()
-
-    def __init__(self, editor, index, pixmap):
-        super().__init__()
-        self.editor = editor
-        self.index = index
-        layout = QVBoxLayout()
-        layout.setContentsMargins(0, 0, 0, 0)
-        layout.setSpacing(2)
-        
-        self.drag_scroll_timer = QTimer(self)
-        self.drag_scroll_timer.setInterval(50)
-        self.drag_scroll_timer.timeout.connect(self.scroll_while_dragging)
-
-        self.label = QLabel()
-        self.label.setPixmap(pixmap.scaledToHeight(60))
-        layout.addWidget(self.label, alignment=Qt.AlignmentFlag.AlignCenter)
-
-        duration = self.editor.durations[self.index] if hasattr(self.editor, 'durations') else 100
-        self.text = QLabel(f"#{index+1} ({duration}ms)")
-        self.text.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.text.setStyleSheet("font-size: 10px; color: gray;")  # Style for index/duration label
-        layout.addWidget(self.text)
-
-        self.duplicate_btn = QPushButton("D")  # 🔧 Fixed indentation
-        self.duplicate_btn.setFixedSize(16, 16)
-        self.duplicate_btn.setStyleSheet("background-color: lightblue; border: none; font-weight: bold;")
-        self.duplicate_btn.clicked.connect(lambda: self.editor.duplicate_frame(self.index))
-        self.duplicate_btn.hide()
-
-        self.delete_btn = QPushButton("X")
-        self.delete_btn.setFixedSize(16, 16)
-        self.delete_btn.setStyleSheet("background-color: lightcoral; border: none; font-weight: bold;")
-        self.delete_btn.clicked.connect(lambda: self.editor.delete_frame(self.index))
-        self.delete_btn.hide()
-
-        self.overlay_layout = QHBoxLayout(self.label)
-        self.overlay_layout.setContentsMargins(0, 0, 0, 0)
-        self.overlay_layout.addWidget(self.duplicate_btn)
-        self.overlay_layout.addStretch()
-        self.overlay_layout.addWidget(self.delete_btn)
-
-        self.setLayout(layout)
-        self.setAcceptDrops(True)
+        self.set_hover_row(-1)
+        super().leaveEvent(event)
 
     def mousePressEvent(self, event):
         if event.button() == Qt.MouseButton.LeftButton:
             self.drag_start_pos = event.pos()
+            self.press_row = self.indexAt(event.pos()).row()
             self.start_scroll_timer()
 
     def mouseMoveEvent(self, event):
         if event.buttons() & Qt.MouseButton.LeftButton:
-            if (event.pos() - self.drag_start_pos).manhattanLength() >= QApplication.startDragDistance():
+            if self.press_row >= 0 and (event.pos() - self.drag_start_pos).manhattanLength() >= QApplication.startDragDistance():
                 drag = QDrag(self)
                 mime = QMimeData()
-                mime.setText(str(self.index))
+                mime.setText(str(self.press_row))
                 drag.setMimeData(mime)
+                self.press_row = -1
                 drag.exec()
+                self.stop_scroll_timer()
+        else:
+            self.set_hover_row(self.indexAt(event.pos()).row())
 
     def mouseReleaseEvent(self, event):
         self.stop_scroll_timer()
-        if event.button() == Qt.MouseButton.LeftButton:
-            if (event.pos() - self.drag_start_pos).manhattanLength() <= QApplication.startDragDistance():
-                self.editor.frame_clicked(self.index)
+        if event.button() == Qt.MouseButton.LeftButton and self.press_row >= 0:
+            row = self.press_row
+            self.press_row = -1
+            if (event.pos() - self.drag_start_pos).manhattanLength() > QApplication.startDragDistance():
+                return
+            duplicate_rect, delete_rect = self.button_rects(row, self.visualRect(self.model().index(row)))
+            if duplicate_rect.contains(event.pos()):
+                self.editor.duplicate_frame(row)
+            elif delete_rect.contains(event.pos()):
+                self.editor.delete_frame(row)
+            else:
+                self.editor.frame_clicked(row)
 
+    # DRAG AND DROP
     def dragEnterEvent(self, event):
-        frame_layout = self.parent.widget().layout()
-        MDL_index = int(self.parent.widget().objectName()[-1:])
-        insertion_line = self.parent.parent.parent.itemAt(1).itemAt(MDL_index).itemAt(0).widget().insertion_line
-        frame_container = self.parent.widget()
-
         if event.mimeData().hasText():
             event.acceptProposedAction()
-            index = self.index
-            target_widget = frame_layout.itemAt(index).widget()
-            if target_widget:
-                geo = target_widget.geometry()
-                insertion_line.setGeometry(
-                    geo.x() - 1, 0, 2, frame_container.height()
-                )
-                insertion_line.show()
-            #self.setStyleSheet("background-color: #d0f0ff; border: 2px dashed #3399ff;")
         else:
             event.ignore()
 
+    def dragMoveEvent(self, event):
+        index = self.indexAt(event.position().toPoint())
+        if event.mimeData().hasText() and index.isValid():
+            geo = self.visualRect(index)
+            self.insertion_line.setGeometry(geo.x() - 2, 0, 2, self.viewport().height())
+            self.insertion_line.show()
+            event.acceptProposedAction()
+        else:
+            self.insertion_line.hide()
+            event.ignore()
+
     def dragLeaveEvent(self, event):
-        MDL_index = int(self.parent.widget().objectName()[-1:])
-        self.parent.parent.parent.itemAt(1).itemAt(MDL_index).itemAt(0).widget().insertion_line.hide()
+        self.insertion_line.hide()
 
     def dropEvent(self, event):
-        MDL_index = int(self.parent.widget().objectName()[-1:])
-        self.parent.parent.parent.itemAt(1).itemAt(MDL_index).itemAt(0).widget().insertion_line.hide()
+        self.insertion_line.hide()
+        index = self.indexAt(event.position().toPoint())
+        if not index.isValid():
+            event.ignore()
+            return
         source_index = int(event.mimeData().text())
-        target_index = self.index
+        target_index = index.row()
         self.editor.reorder_frames(source_index, target_index)
         event.acceptProposedAction()
 
 class AnimatedImageEditor(QWidget):
-    def save_state(self, MDL_index):
-        MDL = self.layout().itemAt(1).itemAt(MDL_index).itemAt(0).widget()
-        self.undo_stack.append((MDL_index, MDL.frames.copy(), MDL.durations.copy(), MDL.current_frame_index))
-        if len(self.undo_stack) > 50:
-            self.undo_stack.pop(0)
-        self.redo_stack.clear()
+    def MDL(self, MDL_index):
+        return self.layout().itemAt(1).itemAt(MDL_index).itemAt(0).widget()
+
+    def run_command(self, command):
+        # Edits wait for the running job, which may be reading the frames.
+        # Returns whether the command ran.
+        if self.refuse_if_busy():
+            return False
+        self.history.run(command, self.MDL(command.MDL_index))
+        return True
+
+    def push_command(self, command):
+        self.history.push(command)
+
+    def busy(self):
+        return self.job is not None
+
+    def refuse_if_busy(self):
+        # whether a running job keeps anything else from starting, after
+        # telling the user so
+        if not self.busy():
+            return False
+        QMessageBox.information(self, "Please Wait", f"{self.job_title}\nWait until it has finished or cancel it first.")
+        return True
+
+    def job_changed(self):
+        # edits, exports and merges are off while a job runs
+        idle = not self.busy()
+        self.export_button.setEnabled(idle)
+        if self.combine_button is not None:
+            self.combine_button.setEnabled(idle)
+        for idx in range(self.numOfMDL):
+            MDL = self.MDL(idx)
+            if hasattr(MDL, 'buttons'):
+                MDL.set_editable(idle)
+
+    def start_job(self, title, work, on_done, error_text, on_publish=None):
+        # Runs work(job) in the background behind a window-modal progress
+        # dialog, then on_done(result) on the GUI thread. Nothing happens if
+        # the job fails or is cancelled, or if another job is still running.
+        # With on_publish, partial results are handed to it as they come and
+        # the window stays usable meanwhile; only edits wait for the job.
+        if self.refuse_if_busy():
+            return False
+        dialog = QProgressDialog(title, "Cancel", 0, 0, self)
+        dialog.setWindowTitle("Animated Image Editor")
+        if on_publish is None:
+            dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        dialog.setMinimumDuration(JOB_DIALOG_DELAY_MS)
+        dialog.setAutoReset(False)
+        dialog.setAutoClose(False)
+        job = BackgroundJob(work)
+
+        def progressed(done, total):
+            dialog.setMaximum(total)
+            dialog.setValue(done)
+
+        def finished():
+            self.job = None
+            self.job_changed()
+            dialog.canceled.disconnect()
+            dialog.close()
+            dialog.deleteLater()
+
+        def succeeded(result):
+            finished()
+            on_done(result)
+
+        def failed(error):
+            finished()
+            if not isinstance(error, engine.Cancelled):
+                QMessageBox.critical(self, "Error", f"{error_text}: {str(error)}")
+
+        job.progressed.connect(progressed)
+        if on_publish is not None:
+            job.published.connect(on_publish)
+        job.succeeded.connect(succeeded)
+        job.failed.connect(failed)
+        dialog.canceled.connect(job.cancel)
+        self.job = job
+        self.job_title = title
+        self.job_changed()
+        job.start()
+        return True
 
     def undo(self):
-        if self.undo_stack:
-            state = self.undo_stack.pop()
-            # if state[0] == 1 and not self.isDualModeOn:
-            #     self.enable_dual_mode()
-
-            MDL = self.layout().itemAt(1).itemAt(state[0]).itemAt(0).widget()
-            self.redo_stack.append(MDL.get_current_state())
-            
-            MDL.overwrite_state(state[1].copy(), state[2].copy(), state[3])
-            MDL.populate_frame_area()
-            MDL.display_frame(state[3])
+        if self.refuse_if_busy():
+            return
+        MDL = self.history.undo(self.MDL)
+        if MDL is not None:
+            MDL.highlight_selected_frames()
+            MDL.display_frame(MDL.current_frame_index)
 
     def redo(self):
-        if self.redo_stack:
-            state = self.redo_stack.pop()
-            MDL = self.layout().itemAt(1).itemAt(state[0]).itemAt(0).widget()
-            self.undo_stack.append(MDL.get_current_state())
-
-            MDL.overwrite_state(state[1].copy(), state[2].copy(), state[3])
-            MDL.populate_frame_area()
-            MDL.display_frame(state[3])
+        if self.refuse_if_busy():
+            return
+        MDL = self.history.redo(self.MDL)
+        if MDL is not None:
+            MDL.highlight_selected_frames()
+            MDL.display_frame(MDL.current_frame_index)
 
     def select_all(self):
         return
@@ -642,19 +1166,25 @@ class AnimatedImageEditor(QWidget):
         elif ctrl and event.key() == Qt.Key.Key_A:
             self.select_all()
             return
+        elif ctrl and shift and event.key() == Qt.Key.Key_T:
+            self.toggle_trace_overlay()
+            return
 
-        if event.key() == Qt.Key.Key_Delete:
+        if event.key() == Qt.Key.Key_Delete and not self.refuse_if_busy():
             for idx in range(self.numOfMDL):
                 MDL = self.layout().itemAt(1).itemAt(idx).itemAt(0).widget()
                 MDL.deleteSelectedFrames()
             return
 
     def __init__(self):
-        self.undo_stack = []
-        self.redo_stack = []
+        self.history = UndoHistory()
+        self.job = None
+        self.job_title = ""
+        self.combine_button = None
 
         super().__init__()
         self.setObjectName("AIE")
+        self.thumbnail_cache = ThumbnailCache()
         self.setWindowTitle("Animated Image Editor")
         self.resize(1280, 800)
         self.numOfMDL = 1
@@ -684,22 +1214,8 @@ class AnimatedImageEditor(QWidget):
         self.middle_layout = QVBoxLayout()
         self.middle_layout.setObjectName("middle")
 
-        frame_area = QScrollArea()
+        frame_area = FrameTimeline(main_label, self.thumbnail_cache)
         frame_area.parent = self.middle_layout
-        frame_area.setObjectName("frame_area")
-        frame_area.setWidgetResizable(True)
-        frame_area.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
-        frame_area.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAsNeeded)
-        frame_area.setFixedHeight(120)
-        frame_area.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
-        frame_container = QWidget()
-        frame_container.setObjectName("frame_container 0")
-        frame_layout = QHBoxLayout()
-        frame_layout.setObjectName("frame_layout")
-        frame_container.setLayout(frame_layout)
-        frame_container.setMinimumHeight(90)
-        frame_area.setWidget(frame_container)
-
         self.middle_layout.addWidget(frame_area)
 
 
@@ -710,9 +1226,21 @@ class AnimatedImageEditor(QWidget):
         self.play_button = QPushButton("Play")
         self.play_button.clicked.connect(self.toggle_play_pause)
         self.bottom_layout.addWidget(self.play_button, alignment=Qt.AlignmentFlag.AlignCenter)
-        export_button = QPushButton("Export")
-        export_button.clicked.connect(self.export_animation)
-        self.bottom_layout.addWidget(export_button, alignment=Qt.AlignmentFlag.AlignCenter)
+        self.export_button = QPushButton("Export")
+        self.export_button.clicked.connect(self.export_animation)
+        self.bottom_layout.addWidget(self.export_button, alignment=Qt.AlignmentFlag.AlignCenter)
+        self.export_profile_combo_box = QComboBox()
+        for name in engine.EXPORT_PROFILES:
+            self.export_profile_combo_box.addItem(name.capitalize(), name)
+        self.export_profile_combo_box.setCurrentIndex(self.export_profile_combo_box.findData(engine.DEFAULT_EXPORT_PROFILE))
+        self.export_profile_combo_box.setToolTip("Export speed/size trade-off")
+        self.bottom_layout.addWidget(self.export_profile_combo_box, alignment=Qt.AlignmentFlag.AlignCenter)
+        self.export_dither_combo_box = QComboBox()
+        self.export_dither_combo_box.addItem("Profile Dithering", None)
+        for name, dither in engine.GIF_DITHERS.items():
+            self.export_dither_combo_box.addItem("No Dithering" if name == "none" else f"{name.title()} Dithering", dither)
+        self.export_dither_combo_box.setToolTip("GIF dithering; ordered is faster than Floyd-Steinberg")
+        self.bottom_layout.addWidget(self.export_dither_combo_box, alignment=Qt.AlignmentFlag.AlignCenter)
 
         # MAIN LAYOUT
         layout = QVBoxLayout()
@@ -733,7 +1261,116 @@ class AnimatedImageEditor(QWidget):
 
         self.setLayout(layout)
 
-    
+        # TRACING
+        self.trace_overlay = QLabel(self)
+        self.trace_overlay.setStyleSheet("background-color: rgba(0, 0, 0, 180); color: white; font-family: monospace; font-size: 11px; padding: 6px;")
+        self.trace_overlay.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+        self.trace_overlay.move(10, 10)
+        self.trace_overlay.hide()
+        self.trace_timer = QTimer(self)
+        self.trace_timer.setInterval(TRACE_REFRESH_MS)
+        self.trace_timer.timeout.connect(self.refresh_trace)
+        if tracer.enabled:
+            self.trace_timer.start()
+
+    def contextMenuEvent(self, event):
+        menu = QMenu(self)
+        trace_action = menu.addAction("Trace Operations")
+        trace_action.setCheckable(True)
+        trace_action.setChecked(tracer.enabled)
+        trace_action.triggered.connect(self.set_tracing)
+        overlay_action = menu.addAction("Show Trace Overlay")
+        overlay_action.setCheckable(True)
+        overlay_action.setChecked(self.trace_overlay.isVisible())
+        overlay_action.triggered.connect(self.toggle_trace_overlay)
+        menu.addSeparator()
+        save_action = menu.addAction("Save Trace...")
+        save_action.setEnabled(bool(tracer.events))
+        save_action.triggered.connect(self.save_trace)
+        menu.exec(event.globalPos())
+
+    # TRACING FUNCTIONS
+    def set_tracing(self, enabled):
+        tracer.enabled = enabled
+        if enabled:
+            self.trace_timer.start()
+        else:
+            self.trace_timer.stop()
+            self.trace_overlay.hide()
+
+    def toggle_trace_overlay(self):
+        if self.trace_overlay.isVisible():
+            self.trace_overlay.hide()
+            return
+        self.set_tracing(True)
+        self.trace_overlay.show()
+        self.trace_overlay.raise_()
+        self.refresh_trace()
+
+    def memory_report(self):
+        # Bytes held by the frames of each animation, by every undo/redo step
+        # and by the caches. Frames in scratch files take disk space instead.
+        MDLs = [self.MDL(i) for i in range(self.numOfMDL)]
+        frames = {}
+        for i, MDL in enumerate(MDLs):
+            entries = MDL.frames.entries() if MDL.frames else []
+            scratch = {id(e.stack): e.stack for e in entries if isinstance(e, StackFrame) and e.stack.on_disk}
+            frames[f"animation {i + 1}"] = {"memory": held_bytes(entries),
+                                            "disk": sum(stack.pixels.nbytes for stack in scratch.values())}
+        return {
+            "frames": frames,
+            "undo": [{"step": type(c).__name__, "animation": c.MDL_index + 1, "bytes": c.undo_bytes}
+                     for c in self.history.undo_stack],
+            "redo": [{"step": type(c).__name__, "animation": c.MDL_index + 1, "bytes": c.redo_bytes}
+                     for c in self.history.redo_stack],
+            "caches": {
+                "decoded frames": frame_cache.nbytes,
+                "export": engine.export_cache.nbytes,
+                "scaled previews": sum(MDL.scaled_pixmaps.nbytes for MDL in MDLs),
+                "preview pyramid": sum(MDL.preview_pyramid.nbytes for MDL in MDLs),
+                "thumbnails": sum(p.width() * p.height() * 4 for p in list(self.thumbnail_cache.pixmaps.values())),
+            },
+        }
+
+    def refresh_trace(self):
+        report = self.memory_report()
+        counters = {f"{name} frames": held["memory"] for name, held in report["frames"].items()}
+        counters["history"] = self.history.nbytes
+        counters.update(report["caches"])
+        tracer.counter("memory", {name: round(nbytes / 1024 / 1024, 1) for name, nbytes in counters.items()})
+        if not self.trace_overlay.isVisible():
+            return
+        lines = ["MEMORY"]
+        for name, held in report["frames"].items():
+            line = f"  {name} frames: {megabytes(held['memory'])}"
+            if held["disk"]:
+                line += f" (+ {megabytes(held['disk'])} on disk)"
+            lines.append(line)
+        for name, nbytes in report["caches"].items():
+            lines.append(f"  {name} cache: {megabytes(nbytes)}")
+        for stack in ("undo", "redo"):
+            steps = report[stack]
+            lines.append(f"  {stack}: {len(steps)} steps, {megabytes(sum(step['bytes'] for step in steps))}")
+            # the next step to undo / redo first
+            for step in steps[:-TRACE_OVERLAY_STEPS - 1:-1]:
+                lines.append(f"    {step['step']} (animation {step['animation']}): {megabytes(step['bytes'])}")
+        lines.append("RECENT SPANS")
+        for name, seconds, args in reversed(tracer.recent(TRACE_OVERLAY_SPANS)):
+            details = " ".join(f"{key}={value}" for key, value in args.items())
+            lines.append(f"  {name} {seconds * 1000:.1f} ms {details}")
+        self.trace_overlay.setText("\n".join(lines))
+        self.trace_overlay.adjustSize()
+
+    def save_trace(self):
+        from PyQt6.QtWidgets import QFileDialog
+        path, _ = QFileDialog.getSaveFileName(self, "Save Trace", "trace.json", "Chrome Trace Files (*.json)")
+        if not path:
+            return
+        try:
+            tracer.dump(path, {"memory": self.memory_report()})
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Failed to save trace: {str(e)}")
+
     # BUTTON FUNCTIONS
     def toggle_play_pause(self):
         for i in range(self.top_layout.count()):
@@ -742,14 +1379,17 @@ class AnimatedImageEditor(QWidget):
                 QMessageBox.warning(self, "Warning", "No frames to play.")
                 return
             if MDL.is_playing:
-                MDL.timer.stop()
+                MDL.playback.stop()
                 self.play_button.setText("Play")
             else:
-                MDL.timer.start(100)
+                MDL.playback.start()
                 self.play_button.setText("Pause")
             MDL.is_playing = not MDL.is_playing
 
     def export_animation(self):
+        # checked before asking for a path, the export could not start anyway
+        if self.refuse_if_busy():
+            return
         if self.isDualModeOn:
             # merge frames from the two MDLs
             frames = []
@@ -768,46 +1408,19 @@ class AnimatedImageEditor(QWidget):
             return
 
         ext = os.path.splitext(path)[-1].lower()
-        if ext not in [".gif", ".webp"]:
+        if ext not in engine.EXPORT_EXTENSIONS:
             QMessageBox.warning(self, "Invalid Format", "Only .gif or .webp extensions are supported.")
             return
 
-        try:
-            if ext == ".webp":
-                frames[0].save(
-                    path,
-                    save_all=True,
-                    append_images=frames[1:],
-                    duration=MDL.durations,
-                    loop=0,
-                    optimize=True,
-                    format="GIF" if ext == ".gif" else "WEBP"
-                )
-            else:
-                def chunk_frames(frames, chunk_size=64):
-                    for i in range(0, len(frames), chunk_size):
-                        yield frames[i:i+chunk_size]
-
-                chunks = list(chunk_frames(frames))
-                export_frames = []
-                for chunk in chunks:
-                    # palette=Image.WEB
-                    base_palette = chunk[0].convert("RGB").convert("P", palette=Image.ADAPTIVE, dither=Image.NONE)
-                    for frame in chunk:
-                        export_frames.append(frame.convert("RGB").quantize(palette=base_palette))
-
-                export_frames[0].save(
-                    path,
-                    save_all=True,
-                    append_images=export_frames[1:],
-                    duration=MDL.durations,
-                    loop=0,
-                    optimize=True,
-                    format="GIF" if ext == ".gif" else "WEBP"
-                )
-            QMessageBox.information(self, "Success", f"Animation saved to {path}")
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to export: {str(e)}")
+        durations = list(MDL.durations)
+        profile = self.export_profile_combo_box.currentData()
+        dither = self.export_dither_combo_box.currentData()
+        def export(job):
+            return engine.export_animation(path, frames, durations, profile=profile, progress=job.progress,
+                                           dither=dither)
+        def exported(result):
+            QMessageBox.information(self, "Success", f"Animation saved to {path}\n{result.summary()}")
+        self.start_job(f"Saving {os.path.basename(path)}...", export, exported, "Failed to export")
 
     def enable_dual_mode(self, file_path, mode):
         self.numOfMDL = 2
@@ -833,97 +1446,31 @@ class AnimatedImageEditor(QWidget):
 
 
         # MIDDLE LAYOUT
-        frame_area = QScrollArea()
+        frame_area = FrameTimeline(main_label, self.thumbnail_cache)
         frame_area.parent = self.middle_layout
-        frame_area.setObjectName("frame_area")
-        frame_area.setWidgetResizable(True)
-        frame_area.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
-        frame_area.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAsNeeded)
-        frame_area.setFixedHeight(120)
-        frame_area.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
-        frame_container = QWidget()
-        frame_container.setObjectName("frame_container 1")
-        frame_layout = QHBoxLayout()
-        frame_layout.setObjectName("frame_layout")
-        frame_container.setLayout(frame_layout)
-        frame_container.setMinimumHeight(90)
-        frame_area.setWidget(frame_container)
-
         self.middle_layout.addWidget(frame_area)
 
         main_label.load_animation(file_path)
-        self.save_state(1)
 
         # ADD MERGE or CONCAT BUTTON AT THE BOTTOM LAYOUT
         if mode == MODE_MERGE:
-            merge_button = QPushButton("Merge")
-            merge_button.clicked.connect(self.handle_merge)
-            self.bottom_layout.addWidget(merge_button, alignment=Qt.AlignmentFlag.AlignCenter)
+            self.combine_button = QPushButton("Merge")
+            self.combine_button.clicked.connect(self.handle_merge)
         elif mode == MODE_CONCAT:
-            concat_button = QPushButton("Concatenate")
-            concat_button.clicked.connect(self.handle_concat)
-            self.bottom_layout.addWidget(concat_button, alignment=Qt.AlignmentFlag.AlignCenter)
+            self.combine_button = QPushButton("Concatenate")
+            self.combine_button.clicked.connect(self.handle_concat)
+        self.bottom_layout.addWidget(self.combine_button, alignment=Qt.AlignmentFlag.AlignCenter)
+        self.job_changed()
 
     def handle_concat(self):
         MDL_1 = self.top_layout.itemAt(0).itemAt(0).widget()
         MDL_2 = self.top_layout.itemAt(1).itemAt(0).widget()
+        frames1, durations1 = MDL_1.frames, MDL_1.durations.copy()
+        frames2, durations2 = MDL_2.frames, MDL_2.durations.copy()
 
-        w1, h1 = MDL_1.frames[0].size
-        w2, h2 = MDL_2.frames[0].size
-
-        width1, height1, width2, height2, is_resizing_1 = self.calc_resizing_metrics(w1, h1, w2, h2)
-        container_width = max(width1, width2)
-        container_height = height1
-
-        # CENTER (container_width - width2) // 2 
-        # LEFT 0
-        # RIGHT container_width - width2
-        if is_resizing_1:
-            resized2 = []
-            if container_width > width2:
-                for f in MDL_2.frames:
-                    container = Image.new("RGB", (container_width, container_height), (0, 0, 0))
-                    container.paste(f, ((container_width - width2) // 2, 0))
-                    resized2.append(container.convert("RGBA"))
-                    f.close()
-            else:
-                resized2 = [f.copy() for f in MDL_2.frames]
-
-            resized1 = []
-            MDL_1.resize_frames(height1)
-            for f in MDL_1.frames:
-                container = Image.new("RGB", (container_width, container_height), (0, 0, 0))
-                container.paste(f, ((container_width - width1) // 2, 0))
-                resized1.append(container.convert("RGBA"))
-                f.close()
-        else:
-            resized1 = []
-            if container_width > width1:
-                for f in MDL_1.frames:
-                    container = Image.new("RGB", (container_width, container_height), (0, 0, 0))
-                    container.paste(f, ((container_width - width1) // 2 , 0))
-                    resized1.append(container.convert("RGBA"))
-                    f.close()
-            else:
-                resized1 = MDL_1.frames
-
-            resized2 = []
-            MDL_2.resize_frames(height2)
-            for f in MDL_2.frames:
-                container = Image.new("RGB", (container_width, container_height), (0, 0, 0))
-                container.paste(f, ((container_width - width2) // 2 , 0))
-                resized2.append(container.convert("RGBA"))
-                f.close()
-
-        resized1.extend(resized2)
-        d = MDL_1.durations + MDL_2.durations
-        
-        MDL_1.overwrite_state(resized1.copy(), d.copy(), 0)
-        MDL_1.populate_frame_area()
-        MDL_1.display_frame(0)
-        MDL_2.reset()
-        self.enable_single_mode()
-    
+        def concat(job):
+            return engine.concat_animations(frames1, durations1, frames2, durations2, job.progress)
+        self.start_job("Concatenating...", concat, self.combined, "Failed to concatenate")
 
     def handle_merge(self):
         MDL_1 = self.top_layout.itemAt(0).itemAt(0).widget()
@@ -931,124 +1478,30 @@ class AnimatedImageEditor(QWidget):
         
         if MDL_1.is_playing:
             self.toggle_play_pause()
+        frames1, durations1 = MDL_1.frames, MDL_1.durations.copy()
+        frames2, durations2 = MDL_2.frames, MDL_2.durations.copy()
 
-        if len(MDL_1.frames) == 1:
-            num_of_frames = len(MDL_2.frames)
-            MDL_1.frames = MDL_1.frames * num_of_frames
-            MDL_1.durations = MDL_2.durations.copy()
-        elif len(MDL_2.frames) == 1:
-            num_of_frames = len(MDL_1.frames)
-            MDL_2.frames = MDL_2.frames * num_of_frames
-            MDL_2.durations = MDL_1.durations.copy()
-
-        else:
-            self.adjust_frame_durations(MDL_1, MDL_2)
+        def merge(job):
+            return engine.merge_animations(frames1, durations1, frames2, durations2, progress=job.progress)
+        self.start_job("Merging...", merge, self.combined, "Failed to merge")
 
-        self.merge_images(MDL_1, MDL_2)
-        self.enable_single_mode()
-    
-    def adjust_frame_durations(self, MDL_1, MDL_2):
-        d1 = MDL_1.durations
-        d2 = MDL_2.durations
-
-        sum1 = sum(d1)
-        sum2 = sum(d2)
-
-        if sum1 > sum2:
-            leftover = 0
-            for idx, d in enumerate(d2):
-                proportion = d / sum2
-                int_part, frac_part = custom_round(sum1 * proportion)
-                leftover += frac_part
-                d2[idx] = int(int_part)
-            
-            leftover = round(leftover)
-
-            MDL_2.durations = d2
-
-        else:
-            leftover = 0
-            for idx, d in enumerate(d1):
-                proportion = d / sum1
-                int_part, frac_part = custom_round(sum2 * proportion)
-                leftover += frac_part
-                d1[idx] = int(int_part)
-            
-            leftover = round(leftover)
-
-            MDL_1.durations = d1
-    
-    def calc_resizing_metrics(self, w1, h1, w2, h2):
-        new_height = max(h1, h2)
-        if new_height == h1:
-            aspect_ratio = h2 / w2
-            new_width = int(new_height / aspect_ratio)
-            w2 = new_width
-            h2 = new_height
-            is_resizing_1 = False
-        else:
-            aspect_ratio = h1 / w1
-            new_width = int(new_height / aspect_ratio)
-            w1 = new_width
-            h1 = new_height
-            is_resizing_1 = True
-
-        return w1, h1, w2, h2, is_resizing_1
-    
-    def merge_images(self, MDL_1, MDL_2):
-        concat_frames = []
-        concat_durations = []
-
-        w1, h1 = MDL_1.frames[0].size
-        w2, h2 = MDL_2.frames[0].size
-        width1, height1, width2, height2, is_resizing_1 = self.calc_resizing_metrics(w1, h1, w2, h2)
-        combined_width = width1 + width2
-        combined_height = height1
-
-        # Pre-resize all frames
-        if is_resizing_1:
-            MDL_1.resize_frames(height1)
-        else:
-            MDL_2.resize_frames(height2)
-        
-        resized1 = MDL_1.frames
-        resized2 = MDL_2.frames
-
-        i, j = 0, 0
-        durs1 = MDL_1.durations[:]
-        durs2 = MDL_2.durations[:]
-
-        while i < len(resized1) and j < len(resized2):
-            frame1 = resized1[i]
-            frame2 = resized2[j]
-
-            combined_image = Image.new("RGB", (combined_width, combined_height), (0, 0, 0))
-            combined_image.paste(frame1, (0, 0))
-            combined_image.paste(frame2, (width1, 0))
-            combined_image.thumbnail((1920, 1920))
-
-            d1, d2 = durs1[i], durs2[j]
-            consumed = min(d1, d2)
-
-            durs1[i] -= consumed
-            durs2[j] -= consumed
-
-            if durs1[i] == 0:
-                i += 1
-            if durs2[j] == 0:
-                j += 1
-
-            concat_frames.append(combined_image.convert("RGBA"))
-            concat_durations.append(consumed)
-
-        MDL_1.overwrite_state(concat_frames.copy(), concat_durations.copy(), 0)
+    def combined(self, result):
+        # a finished merge or concat replaces the first animation
+        MDL_1 = self.top_layout.itemAt(0).itemAt(0).widget()
+        MDL_2 = self.top_layout.itemAt(1).itemAt(0).widget()
+        frames, durations = result
+        old_entries, old_durations = MDL_1.frames.entries(), MDL_1.durations.copy()
+        MDL_1.overwrite_state(frames, durations, 0)
+        self.push_command(ReplaceFramesCommand(0, old_entries, old_durations, MDL_1.frames.entries(), MDL_1.durations))
         MDL_1.populate_frame_area()
         MDL_1.display_frame(0)
         MDL_2.reset()
+        self.enable_single_mode()
     
     def enable_single_mode(self):
         self.numOfMDL = 1
         self.isDualModeOn = False
+        self.history.discard(1)
 
         # TOP LAYOUT
         top_sub_1 = self.top_layout.itemAt(1)
@@ -1058,22 +1511,17 @@ class AnimatedImageEditor(QWidget):
 
         # MIDDLE LAYOUT
         frame_area_1 = self.middle_layout.itemAt(1).widget()
-        frame_container = frame_area_1.widget()
-        frame_layout = frame_container.layout()
-        deleteItemsOfLayout(frame_layout)
-        frame_layout.parent = None
-        frame_layout.deleteLater()
-        frame_container.deleteLater()
         frame_area_1.deleteLater()
 
         # BOTTOM LAYOUT
-        merge_button = self.bottom_layout.itemAt(2).widget()
+        # added last by enable_dual_mode
+        merge_button = self.bottom_layout.itemAt(self.bottom_layout.count() - 1).widget()
         merge_button.setParent(None)
         merge_button.deleteLater()
+        self.combine_button = None
     
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     window = AnimatedImageEditor()
     window.show()
-    window.resizeEvent = lambda event: (window.display_frame(window.current_frame_index), QWidget.resizeEvent(window, event))
     sys.exit(app.exec())
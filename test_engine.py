@@ -0,0 +1,252 @@
+'''
+Behaviour checks for the editing engine, the undo history and the command
+line tool, on small animations made up on the spot.
+
+    python -m pytest -q
+'''
+
+import io
+import os
+import random
+import numpy as np
+import pytest
+from PIL import Image
+import aie
+import engine
+from frame_store import FrameSequence, StoredFrame
+
+SIZE = (64, 48)
+BACKGROUND = (20, 40, 200, 255)
+
+def make_frame(i):
+    # a few flat colors: every palette the export profiles build holds them exactly
+    frame = Image.new("RGBA", SIZE, BACKGROUND)
+    frame.paste((250, 200, 0, 255), (4 * i % 48, 8, 4 * i % 48 + 16, 24))
+    frame.paste((0, 160, 60, 255), (0, 36, 64, 48))
+    return frame
+
+def make_frames(n):
+    return [make_frame(i) for i in range(n)]
+
+def save_gif(path, frames, durations):
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=durations, loop=0)
+
+def decode(data):
+    frames, durations = [], []
+    with Image.open(io.BytesIO(data)) as image:
+        for i in range(image.n_frames):
+            image.seek(i)
+            frames.append(np.array(image.convert("RGBA")))
+            durations.append(image.info["duration"])
+    return frames, durations
+
+@pytest.mark.parametrize("profile", list(engine.EXPORT_PROFILES))
+def test_write_gif_decodes_to_source(profile):
+    frames = make_frames(10)
+    # a repeat is folded into the frame before it
+    frames.insert(4, frames[3].copy())
+    durations = [30, 40, 50, 60, 70, 80, 90, 100, 110, 120, 130]
+    fp = io.BytesIO()
+    engine.write_gif(fp, frames, durations, profile=engine.EXPORT_PROFILES[profile])
+    decoded, decoded_durations = decode(fp.getvalue())
+
+    expected = frames[:4] + frames[5:]
+    assert len(decoded) == len(expected)
+    for frame, pixels in zip(expected, decoded):
+        assert np.array_equal(np.array(frame), pixels)
+    assert decoded_durations == [30, 40, 50, 130, 80, 90, 100, 110, 120, 130]
+
+def test_write_gif_again_is_the_same():
+    # a second export reuses the cached deltas
+    frames = make_frames(8)
+    durations = [50] * 8
+    first, second = io.BytesIO(), io.BytesIO()
+    engine.write_gif(first, frames, durations)
+    engine.write_gif(second, frames, durations)
+    assert first.getvalue() == second.getvalue()
+
+def test_coalesce_frames():
+    a, b, c = make_frame(0), make_frame(1), make_frame(2)
+    frames = [a, a, b, a.copy(), c, c.copy()]
+    durations = [10, 20, 30, 40, 50, 60]
+    kept, kept_durations, removed = engine.coalesce_frames(frames, durations)
+    assert removed == 2
+    assert kept_durations == [30, 30, 40, 110]
+    assert [np.array_equal(np.array(k), np.array(f)) for k, f in zip(kept, [a, b, a, c])] == [True] * 4
+    assert sum(kept_durations) == sum(durations)
+
+def test_adjust_frame_durations_totals():
+    random.seed(3)
+    for _ in range(50):
+        d1 = [random.randint(10, 200) for _ in range(random.randint(1, 30))]
+        d2 = [random.randint(10, 200) for _ in range(random.randint(1, 30))]
+        a1, a2 = engine.adjust_frame_durations(d1, d2)
+        assert sum(a1) == sum(a2) == max(sum(d1), sum(d2))
+        assert len(a1) == len(d1) and len(a2) == len(d2)
+
+def test_align_steps_total_and_tick():
+    random.seed(4)
+    for _ in range(50):
+        d1 = [random.randint(1, 120) for _ in range(random.randint(1, 40))]
+        d2 = [random.randint(1, 120) for _ in range(random.randint(1, 40))]
+        tick = random.choice([1, 10, 20])
+        max_frames = random.choice([None, 5, 20])
+        steps1, steps2, step_durations = engine.align_steps(d1, d2, tick, max_frames)
+        end = min(sum(d1), sum(d2))
+        assert sum(step_durations) == end
+        assert len(steps1) == len(steps2) == len(step_durations)
+        if max_frames:
+            assert len(step_durations) <= max_frames
+        # steps start on the tick grid and none is shorter than a tick
+        starts = np.cumsum([0] + step_durations[:-1])
+        assert all(start % tick == 0 for start in starts)
+        if end >= tick:
+            assert min(step_durations) >= tick
+        assert steps1 == sorted(steps1) and steps2 == sorted(steps2)
+        assert 0 <= steps1[0] and steps1[-1] < len(d1) and steps2[-1] < len(d2)
+
+def test_merge_animations_total():
+    frames1, frames2 = make_frames(6), make_frames(9)
+    durations1 = [70, 30, 50, 90, 40, 60]
+    durations2 = [20, 40, 60, 80, 100, 30, 50, 70, 90]
+    frames, durations = engine.merge_animations(frames1, durations1, frames2, durations2)
+    assert len(frames) == len(durations)
+    assert sum(durations) == max(sum(durations1), sum(durations2))
+    assert frames[0].size[1] == SIZE[1]
+
+    # a still image is held for the whole animation
+    frames, durations = engine.merge_animations(frames1[:1], [100], frames2, durations2)
+    assert sum(durations) == sum(durations2)
+
+def test_frame_sequence_matches_list():
+    random.seed(5)
+    entries = [StoredFrame(frame) for frame in make_frames(6)]
+    seq = FrameSequence.from_entries(entries)
+    ref = list(entries)
+    for _ in range(300):
+        op = random.choice(["insert", "delete", "slice", "set", "move", "reverse"])
+        if op == "insert":
+            index, entry = random.randint(0, len(ref)), random.choice(entries)
+            seq.insert(index, entry)
+            ref.insert(index, entry)
+        elif op == "delete" and len(ref) > 1:
+            index = random.randrange(len(ref))
+            del seq[index]
+            del ref[index]
+        elif op == "slice" and len(ref) > 2:
+            start = random.randrange(len(ref))
+            stop = random.randint(start, len(ref))
+            del seq[start:stop]
+            del ref[start:stop]
+        elif op == "set":
+            index, entry = random.randrange(len(ref)), random.choice(entries)
+            seq[index] = entry
+            ref[index] = entry
+        elif op == "move":
+            positions = sorted(random.sample(range(len(ref)), random.randint(1, len(ref))))
+            rest = [e for i, e in enumerate(ref) if i not in positions]
+            insert_pos = random.randint(0, len(rest))
+            seq.move(positions, insert_pos)
+            ref = rest[:insert_pos] + [ref[i] for i in positions] + rest[insert_pos:]
+        elif op == "reverse":
+            seq.reverse()
+            ref.reverse()
+        if not ref:
+            ref = [entries[0]]
+            seq.append(entries[0])
+        assert seq.entries() == ref
+        # only what is on the timeline stays in the pool
+        assert len(seq._pool) == len(set(ref))
+        assert all(seq._slots[entry] == slot for slot, entry in enumerate(seq._pool))
+
+    assert (seq * 2).entries() == ref * 2
+    assert seq[1:3].entries() == ref[1:3]
+    assert len(seq[1:3]._pool) == len(set(ref[1:3]))
+
+@pytest.fixture(scope="module")
+def editor():
+    pytest.importorskip("PyQt6.QtWidgets")
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+    import main
+    app = QApplication.instance() or QApplication([])
+    window = main.AnimatedImageEditor()
+    window.show()
+    app.processEvents()
+
+    def wait():
+        while window.job is not None:
+            app.processEvents()
+    window.wait = wait
+    yield window
+    window.close()
+
+def test_undo_redo_round_trip(editor, tmp_path):
+    path = str(tmp_path / "in.gif")
+    save_gif(path, make_frames(12), [40 + 10 * i for i in range(12)])
+    MDL = editor.top_layout.itemAt(0).itemAt(0).widget()
+    MDL.load_animation(path)
+    editor.wait()
+
+    def state():
+        return MDL.frames.entries(), list(MDL.durations)
+
+    random.seed(6)
+    states = [state()]
+    while len(states) <= 30:
+        n = len(MDL.frames)
+        op = random.choice(["durations", "reverse", "pendulum", "move", "duplicate", "delete"])
+        if op == "durations":
+            MDL.selected_indices = set(random.sample(range(n), min(n, 3)))
+            MDL.integer_spin_box.setValue(random.choice([-30, 20]))
+            MDL.update_frame_durations()
+        elif op == "reverse":
+            MDL.reverse_frames()
+        elif op == "pendulum" and n < 40:
+            MDL.pendulum_frames()
+        elif op == "move":
+            MDL.selected_indices = set(random.sample(range(n), min(n, random.randint(1, 3))))
+            MDL.reorder_frames(0, random.randrange(n))
+        elif op == "duplicate":
+            MDL.duplicate_frame(random.randrange(n))
+        elif op == "delete" and n > 2:
+            MDL.delete_frame(random.randrange(n))
+        else:
+            continue
+        assert len(MDL.frames) == len(MDL.durations) == MDL.timeline().model().rowCount()
+        # one state for every command on the undo stack
+        if len(editor.history.undo_stack) == len(states):
+            states.append(state())
+
+    for k in range(len(states) - 1):
+        editor.undo()
+        assert state() == states[-2 - k]
+    for k in range(len(states) - 1):
+        editor.redo()
+        assert state() == states[k + 1]
+
+def test_cli_matches_engine(tmp_path):
+    source = make_frames(10)
+    source.insert(6, source[5].copy())
+    durations = [30, 60, 90, 40, 70, 100, 50, 80, 20, 110, 60]
+    path = str(tmp_path / "in.gif")
+    save_gif(path, source, durations)
+
+    out_dir = str(tmp_path / "out")
+    assert aie.main(["pendulum", path, "--height", "30", "--profile", "archival", "-o", out_dir, "-j", "1"]) == 0
+    frames, durations = engine.load_animation(path)
+    frames = engine.resize_frames(frames, 30)
+    frames, durations = engine.pendulum_frames(frames, durations)
+    direct = str(tmp_path / "direct.gif")
+    engine.export_animation(direct, frames, durations, profile="archival")
+    with open(os.path.join(out_dir, "in.gif"), "rb") as cli, open(direct, "rb") as fp:
+        assert cli.read() == fp.read()
+
+    merged = str(tmp_path / "merged.webp")
+    assert aie.main(["merge", path, path, "--reverse", "-o", merged]) == 0
+    frames, durations = engine.merge_animations(*engine.load_animation(path), *engine.load_animation(path))
+    frames, durations = engine.reverse_frames(frames, durations)
+    direct = str(tmp_path / "direct.webp")
+    engine.export_animation(direct, frames, durations)
+    with open(merged, "rb") as cli, open(direct, "rb") as fp:
+        assert cli.read() == fp.read()
@@ -0,0 +1,97 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Timing spans around the editing hot paths. Enable with AIE_TRACE=1 (or from
+# the editor's context menu); AIE_TRACE_FILE=<path> writes the spans as a
+# Chrome trace (chrome://tracing, ui.perfetto.dev) when the program exits.
+TRACE_ENABLED = os.environ.get("AIE_TRACE", "0") == "1"
+TRACE_FILE = os.environ.get("AIE_TRACE_FILE") or None
+# oldest spans are dropped beyond this many
+TRACE_MAX_SPANS = 200000
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_SPAN = NoSpan()
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.tracer.events.append(("X", self.name, self.start, end - self.start, threading.get_ident(), self.args))
+        return False
+
+class Tracer:
+    # Collects spans and counter samples from any thread. While disabled a
+    # span is a shared no-op, cheap enough to leave around per-frame work.
+    def __init__(self, enabled=TRACE_ENABLED, max_spans=TRACE_MAX_SPANS):
+        self.enabled = enabled
+        self.events = deque(maxlen=max_spans)
+        self.origin = time.perf_counter()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, args)
+
+    def counter(self, name, values):
+        # a sample of named values, drawn as a graph by trace viewers
+        if self.enabled:
+            self.events.append(("C", name, time.perf_counter(), 0, threading.get_ident(), values))
+
+    def recent(self, count):
+        # the last count finished spans as (name, seconds, args), newest last
+        spans = [e for e in list(self.events)[-4 * count:] if e[0] == "X"]
+        return [(name, seconds, args) for _, name, _, seconds, _, args in spans[-count:]]
+
+    def clear(self):
+        self.events.clear()
+
+    def chrome_trace(self, metadata=None):
+        events = []
+        pid = os.getpid()
+        for phase, name, start, seconds, tid, args in list(self.events):
+            event = {"name": name, "ph": phase, "ts": (start - self.origin) * 1e6, "pid": pid, "tid": tid,
+                     "args": args}
+            if phase == "X":
+                event["dur"] = seconds * 1e6
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms", "metadata": metadata or {}}
+
+    def dump(self, path, metadata=None):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(metadata), f, default=str)
+
+tracer = Tracer()
+
+def traced(name):
+    # runs every call of the decorated function in a span
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+if TRACE_FILE:
+    atexit.register(lambda: tracer.dump(TRACE_FILE))